@@ -0,0 +1,118 @@
+import numpy as np
+
+from counts_table import CountsTable, as_counts_table
+from executor import run_batched
+from topo_entropy import kitaev_preskill_signs, subset_purities, tomography_circuit
+from toric_code import get_toric_code
+from toric_code_matching import sample_haar_angles
+
+
+class StreamingTopoEntropy:
+    def __init__(self, subsystems):
+        """
+        Running mean and covariance of the subset purities of randomized measurements, updated batch by batch.
+        The standard error of the topological entropy follows from linearizing -log of the mean purities.
+
+        :param subsystems: Partition of the measured bits, e.g. ABC_DIVISION_2x2
+        """
+        self.subsystems = subsystems
+        self.combos = None
+        self.count = 0
+        self.mean = None
+        self.m2 = None  # sum of outer products of deviations from the mean
+        self.shot_m2 = None  # sum of N (p1 - p2)(p1 - p2)^T / 4 over realizations split into two halves of shots
+        self.inverse_shots = 0.  # sum of 1 / N over realizations
+
+    def __len__(self):
+        return self.count
+
+    def update(self, full_counts, rng=None):
+        table = as_counts_table(full_counts)
+        rng = np.random.default_rng(rng)
+        purities = subset_purities(table, self.subsystems)
+        if self.combos is None:
+            self.combos = list(purities)
+            self.mean = np.zeros(len(self.combos))
+            self.m2 = np.zeros((len(self.combos), len(self.combos)))
+            self.shot_m2 = np.zeros_like(self.m2)
+        batch = np.stack([purities[combo] for combo in self.combos], axis=-1)
+
+        # shot noise from two random halves of every realization
+        half = rng.binomial(table.counts, 0.5)
+        halves = [subset_purities(CountsTable(table.outcomes, c, table.offsets, table.q_cnt), self.subsystems)
+                  for c in (half, table.counts - half)]
+        diff = np.stack([halves[0][combo] - halves[1][combo] for combo in self.combos], axis=-1)
+        self.shot_m2 += np.einsum('r,ri,rj->ij', table.shots, diff, diff) / 4
+        self.inverse_shots += np.sum(1. / table.shots)
+
+        # Chan et al. merge of the batch mean and covariance
+        batch_mean = batch.mean(axis=0)
+        dev = batch - batch_mean
+        delta = batch_mean - self.mean
+        total = self.count + len(batch)
+        self.m2 += dev.T @ dev + np.outer(delta, delta) * self.count * len(batch) / total
+        self.mean += delta * len(batch) / total
+        self.count = total
+
+    def entropies(self):
+        return {combo: -np.log(m) for combo, m in zip(self.combos, self.mean)}
+
+    def signs(self):
+        signs = kitaev_preskill_signs(self.combos)
+        return np.array([signs[combo] for combo in self.combos])
+
+    def topo_entropy(self):
+        return np.dot(self.signs(), -np.log(self.mean))
+
+    def _gradient(self):
+        return -self.signs() / self.mean
+
+    def topo_error(self):
+        if self.count < 2:
+            return np.inf
+        g = self._gradient()
+        return np.sqrt(max(g @ self.m2 @ g / (self.count - 1), 0.) / self.count)
+
+    def suggested_shots(self, overhead_shots=1000, min_shots=128, max_shots=16384):
+        """
+        Shots per realization minimizing the cost for a given error, with variance V_U + a / N per realization
+        and cost overhead_shots + N per realization, N = sqrt(overhead_shots * a / V_U).
+        """
+        g = self._gradient()
+        a = g @ self.shot_m2 @ g / self.count
+        total = g @ self.m2 @ g / max(self.count - 1, 1)
+        mean_shot_var = a * self.inverse_shots / self.count
+        unitary_var = max(total - mean_shot_var, 1e-3 * total)
+        if not unitary_var > 0:
+            # no spread between realizations yet, e.g. a single realization or noiseless outcomes
+            return max_shots
+        return int(np.clip(np.sqrt(overhead_shots * a / unitary_var), min_shots, max_shots))
+
+
+def calculate_topo_entropy_haar_adaptive(backend, size, qubits, subsystems, target_error=0.05, min_realizations=100,
+                                         max_realizations=1000, batch=20, shots=1024, overhead_shots=1000,
+                                         max_shots=16384, rng=None):
+    """
+    Haar randomized measurement of the topological entropy, stopping as soon as its standard error reaches target_error
+    or max_realizations were run. Shots of every batch are chosen from the variance observed so far.
+
+    :param target_error: Standard error of the topological entropy, in nats like the returned entropy
+    :param min_realizations: Realizations run before the error estimate is trusted
+    :param overhead_shots: Cost of one additional realization, in units of shots
+    :return: (topological entropy, standard error, StreamingTopoEntropy)
+    """
+    rng = np.random.default_rng(rng)
+    x, y = size
+    tc = get_toric_code(x, y, len(qubits))
+    tc.measure_haar(qubits, parameterized=True)
+    circ = tomography_circuit(backend, tc)
+
+    stream = StreamingTopoEntropy(subsystems)
+    while len(stream) < max_realizations:
+        angles = sample_haar_angles((min(batch, max_realizations - len(stream)), len(qubits)), rng)
+        all_counts = run_batched(backend, [tc.bind_measurement(circ, setting) for setting in angles], shots=shots)
+        stream.update(CountsTable.from_counts(all_counts, angles), rng)
+        if len(stream) >= min_realizations and stream.topo_error() <= target_error:
+            break
+        shots = stream.suggested_shots(overhead_shots, max_shots=max_shots)
+    return stream.topo_entropy(), stream.topo_error(), stream
@@ -0,0 +1,96 @@
+import numpy as np
+from qiskit.quantum_info import Pauli
+
+
+def string_operator(e_paths=(), m_paths=()):
+    """
+    Minimal Pauli product of the string operators along the paths of e particles (X strings) and m particles
+    (Z strings). A qubit crossed an even number of times by strings of one type is left alone,
+    and a qubit on both an X and a Z string gets Y, up to a global phase.
+
+    :param e_paths: List of paths, every path a list of qubit coordinates (row, col)
+    :param m_paths: List of paths
+    :return: Dictionary {qubit coordinate: 'x', 'y' or 'z'}, sorted by coordinate
+    """
+    x, z = set(), set()
+    for paths, support in ((e_paths, x), (m_paths, z)):
+        for path in paths:
+            for q in path:
+                support ^= {tuple(q)}
+    return {q: 'y' if q in x and q in z else 'x' if q in x else 'z' for q in sorted(x | z)}
+
+
+def apply_string_operator(tc, paulis, frame=True):
+    """
+    Applies the Pauli product to the current state of tc, as gates or in the Pauli frame of tc.
+    A frame costs no gate, it is pushed through the rest of the circuit and applied to the measured outcomes,
+    see frame_flips and apply_frame.
+
+    :param paulis: Dictionary {qubit coordinate: 'x', 'y' or 'z'}, e.g. from string_operator
+    :param frame: Keep the product in the frame instead of applying gates
+    """
+    if frame:
+        tc.frame.append((len(tc.circ.data), paulis))
+        return
+    for (r, c), pauli in paulis.items():
+        getattr(tc.circ, pauli)(tc.regs[r][c])
+
+
+def frame_pauli(tc, paulis):
+    # Pauli of the whole circuit of tc, qubit i of the Pauli is tc.circ.qubits[i]
+    x, z = np.zeros(tc.circ.num_qubits, dtype=bool), np.zeros(tc.circ.num_qubits, dtype=bool)
+    for (r, c), pauli in paulis.items():
+        i = tc.circ.find_bit(tc.regs[r][c]).index
+        x[i], z[i] = pauli in 'xy', pauli in 'yz'
+    return Pauli((z, x))
+
+
+def frame_flips(tc, register=None):
+    """
+    Classical bits of tc flipped by its Pauli frame.
+    Every frame entry is conjugated through the instructions appended after it, which must be Clifford,
+    and flips the bit of every measurement of a qubit on which it has X or Y.
+
+    :param register: Index the bits inside this classical register, e.g. tc.c_reg for counts restricted to it
+        with register_counts. By default bits are indexed in the whole circuit
+    :return: Sorted list of classical bit indices
+    """
+    flips = set()
+    for position, paulis in tc.frame:
+        pauli = frame_pauli(tc, paulis)
+        for inst in tc.circ.data[position:]:
+            name = inst.operation.name
+            qargs = [tc.circ.find_bit(q).index for q in inst.qubits]
+            if name == 'measure':
+                if pauli.x[qargs[0]]:
+                    flips ^= {inst.clbits[0]}
+            elif name == 'reset':
+                pauli.x[qargs[0]] = pauli.z[qargs[0]] = False
+            elif name != 'barrier':
+                pauli = pauli.evolve(inst.operation, qargs, frame='s')
+    if register is None:
+        return sorted(tc.circ.find_bit(bit).index for bit in flips)
+    return sorted(register.index(bit) for bit in flips if bit in register)
+
+
+def apply_frame(counts, flips):
+    """
+    Counts as they would be measured with the frame applied as gates.
+
+    :param flips: Classical bit indices, e.g. from frame_flips. Bit 0 is the rightmost character of an outcome,
+        spaces between registers are skipped
+    """
+    if not flips:
+        return counts
+    res = {}
+    for outcome, count in counts.items():
+        chars, bit = list(outcome), 0
+        for i in reversed(range(len(chars))):
+            if chars[i] == ' ':
+                continue
+            if bit in flips:
+                chars[i] = '1' if chars[i] == '0' else '0'
+            bit += 1
+        flipped = ''.join(chars)
+        res[flipped] = res.get(flipped, 0) + count
+    return res
@@ -0,0 +1,161 @@
+import numpy as np
+
+
+class CountsTable:
+    def __init__(self, outcomes, counts, offsets, q_cnt, settings=None):
+        """
+        Measurement counts of many realizations packed into flat arrays.
+        Outcomes are stored as integer value of the bitstring, so character i of the bitstring is bit q_cnt - 1 - i.
+
+        :param outcomes: Distinct outcomes of every realization
+        :param counts: Number of shots of every outcome
+        :param offsets: Realization r owns outcomes[offsets[r]:offsets[r + 1]]
+        :param q_cnt: Length of the bitstrings
+        :param settings: Optional array with the measurement setting of every realization along the first axis,
+            e.g. u angles (realizations, qubits, 3), so post-processing can be replayed
+        """
+        assert q_cnt <= 64
+        self.outcomes = np.asarray(outcomes, dtype=np.uint64)
+        self.counts = np.asarray(counts, dtype=np.uint32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.q_cnt = q_cnt
+        self.settings = None if settings is None else np.asarray(settings)
+
+    @classmethod
+    def from_counts(cls, all_counts, settings=None):
+        # all_counts is list of dictionaries {s: count}, as returned by Qiskit get_counts
+        outcomes, counts, offsets = [], [], [0]
+        q_cnt = None
+        for realization in all_counts:
+            for s, c in realization.items():
+                s = s.replace(' ', '')
+                q_cnt = len(s)
+                outcomes.append(int(s, 2))
+                counts.append(c)
+            offsets.append(len(outcomes))
+        table = cls(outcomes, counts, offsets, q_cnt).marginal(range(q_cnt))
+        table.settings = None if settings is None else np.asarray(settings)
+        return table
+
+    @classmethod
+    def from_memory(cls, all_memory, settings=None):
+        # all_memory is list of per-shot bitstring lists, as returned by Qiskit get_memory
+        q_cnt = len(all_memory[0][0].replace(' ', ''))
+        powers = np.uint64(1) << np.arange(q_cnt - 1, -1, -1, dtype=np.uint64)
+        shots, realization = [], []
+        for r, memory in enumerate(all_memory):
+            raw = np.frombuffer(''.join(memory).replace(' ', '').encode(), dtype=np.uint8)
+            bits = (raw - ord('0')).reshape(-1, q_cnt).astype(np.uint64)
+            shots.append(bits @ powers)
+            realization.append(np.full(len(memory), r))
+        shots = np.concatenate(shots)
+        table = cls._grouped(np.concatenate(realization), shots, np.ones(len(shots), dtype=np.uint32),
+                             len(all_memory), q_cnt)
+        table.settings = None if settings is None else np.asarray(settings)
+        return table
+
+    @classmethod
+    def concatenate(cls, tables):
+        assert len({t.q_cnt for t in tables}) == 1
+        offsets = [0]
+        for t in tables:
+            offsets.extend(offsets[-1] + t.offsets[1:])
+        settings = None
+        if all(t.settings is not None for t in tables):
+            settings = np.concatenate([t.settings for t in tables])
+        return cls(np.concatenate([t.outcomes for t in tables]), np.concatenate([t.counts for t in tables]), offsets,
+                   tables[0].q_cnt, settings)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, realizations):
+        # selects a subset of realizations, e.g. table[10:20]
+        rows = np.arange(len(self))[realizations]
+        rows = np.atleast_1d(rows)
+        sizes = self.offsets[rows + 1] - self.offsets[rows]
+        idx = np.concatenate([np.arange(self.offsets[r], self.offsets[r + 1]) for r in rows]) if len(rows) else []
+        idx = np.asarray(idx, dtype=np.int64)
+        return CountsTable(self.outcomes[idx], self.counts[idx], np.concatenate(([0], np.cumsum(sizes))), self.q_cnt,
+                           None if self.settings is None else self.settings[rows])
+
+    @property
+    def realization(self):
+        # realization index of every stored outcome
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    @property
+    def shots(self):
+        return np.add.reduceat(self.counts.astype(np.int64), self.offsets[:-1]) if len(self.counts) else \
+            np.zeros(len(self), dtype=np.int64)
+
+    def to_counts(self):
+        all_counts = []
+        for r in range(len(self)):
+            sl = slice(self.offsets[r], self.offsets[r + 1])
+            all_counts.append({format(int(o), f'0{self.q_cnt}b'): int(c)
+                               for o, c in zip(self.outcomes[sl], self.counts[sl])})
+        return all_counts
+
+    def subsystem_outcomes(self, sub_idx):
+        # outcome of every stored entry restricted to the characters sub_idx of the bitstring
+        sub_idx = list(sub_idx)
+        k = len(sub_idx)
+        res = np.zeros(len(self.outcomes), dtype=np.uint64)
+        for j, i in enumerate(sub_idx):
+            bit = (self.outcomes >> np.uint64(self.q_cnt - 1 - i)) & np.uint64(1)
+            res |= bit << np.uint64(k - 1 - j)
+        return res
+
+    def marginal(self, sub_idx):
+        # settings are kept as they are, they describe the measurement of the full bitstring
+        sub_idx = list(sub_idx)
+        table = self._grouped(self.realization, self.subsystem_outcomes(sub_idx), self.counts, len(self), len(sub_idx))
+        table.settings = self.settings
+        return table
+
+    def histograms(self, sub_idx=None):
+        """
+        Dense counts of the marginal distribution on sub_idx.
+
+        :return: Array (realizations, 2 ** len(sub_idx)) indexed by the integer value of the sub-bitstring
+        """
+        if sub_idx is None:
+            sub_idx = range(self.q_cnt)
+        k = len(list(sub_idx))
+        flat = self.realization * 2 ** k + self.subsystem_outcomes(sub_idx).astype(np.int64)
+        hist = np.bincount(flat, weights=self.counts, minlength=len(self) * 2 ** k)
+        return hist.astype(np.int64).reshape(len(self), 2 ** k)
+
+    @staticmethod
+    def _grouped(realization, outcomes, counts, realization_count, q_cnt):
+        # sums counts of repeated (realization, outcome) pairs
+        order = np.lexsort((outcomes, realization))
+        realization, outcomes, counts = realization[order], outcomes[order], counts[order]
+        new = np.ones(len(outcomes), dtype=bool)
+        new[1:] = (realization[1:] != realization[:-1]) | (outcomes[1:] != outcomes[:-1])
+        starts = np.flatnonzero(new)
+        summed = np.add.reduceat(counts.astype(np.int64), starts) if len(starts) else np.zeros(0, dtype=np.int64)
+        offsets = np.searchsorted(realization[starts], np.arange(realization_count + 1))
+        return CountsTable(outcomes[starts], summed, offsets, q_cnt)
+
+
+def as_counts_table(all_counts):
+    if isinstance(all_counts, CountsTable):
+        return all_counts
+    return CountsTable.from_counts(all_counts)
+
+
+def register_counts(counts, register=0):
+    """
+    Counts of one classical register, summed over the others.
+    Qiskit bitstrings list the registers separated by spaces, the last added register first.
+
+    :param counts: Dictionary {s: count}
+    :param register: Position of the register in the bitstrings, 0 is the last added register
+    """
+    res = {}
+    for s, c in counts.items():
+        key = s.split(' ')[register]
+        res[key] = res.get(key, 0) + c
+    return res
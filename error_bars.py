@@ -0,0 +1,142 @@
+import numpy as np
+
+from counts_table import as_counts_table
+from topo_entropy import histogram_pauli_subset_purities, histogram_subset_purities, kitaev_preskill_sum, \
+    pauli_subset_purities, subset_entropies, subset_purities
+
+
+def confidence_interval(replicas, level=0.95):
+    # percentile interval of bootstrap replicas along the first axis
+    alpha = (1 - level) / 2
+    low, high = np.quantile(replicas, [alpha, 1 - alpha], axis=0)
+    return low, high
+
+
+def bootstrap_weights(count, resamples, rng=None):
+    # multiplicity of every realization in every resample, array (resamples, count)
+    rng = np.random.default_rng(rng)
+    return rng.multinomial(count, np.full(count, 1 / count), size=resamples)
+
+
+def resample_shots(hist, resamples, rng=None):
+    """
+    Parametric shot bootstrap, every realization redrawn from its observed distribution with the same shot count.
+
+    :param hist: Array (realizations, outcomes) of counts
+    :return: Array (resamples, realizations, outcomes)
+    """
+    rng = np.random.default_rng(rng)
+    N = hist.sum(axis=-1)
+    p = np.divide(hist, N[:, None], out=np.full(hist.shape, 1 / hist.shape[-1]), where=N[:, None] > 0)
+    return rng.multinomial(N, p, size=(resamples, len(hist)))
+
+
+def bootstrap_subset_purities(full_counts, parts, resamples=1000, shots=True, estimator='randomized', rng=None,
+                              chunk_size=2 ** 24):
+    """
+    Bootstrap replicas of the mean purity of every union of parts, computed from the existing counts.
+    For the randomized estimator realizations are resampled with multinomial weights, for complete Pauli tomography
+    every setting is needed, so only shots are resampled.
+
+    Histograms redrawn from the observed frequencies have the purity of the observed distribution on average,
+    which is larger than the estimate, so shot resampled replicas are shifted to have the estimate as mean.
+
+    :param shots: Also resample the shots of every realization, see resample_shots
+    :param chunk_size: Histogram entries resampled at once, bounds the memory
+    :return: Dictionary {tuple of part indices: array (resamples,) of mean purities}
+    """
+    assert estimator in ('randomized', 'pauli')
+    assert shots or estimator == 'randomized'
+    rng = np.random.default_rng(rng)
+    table = as_counts_table(full_counts)
+    hist = table.histograms([i for part in parts for i in part])
+    R = len(hist)
+
+    if not shots:
+        weights = bootstrap_weights(R, resamples, rng)
+        return {combo: weights @ pur / R for combo, pur in subset_purities(table, parts).items()}
+
+    res = {}
+    step = max(chunk_size // hist.size, 1)
+    for start in range(0, resamples, step):
+        count = min(step, resamples - start)
+        replicas = resample_shots(hist, count, rng)
+        if estimator == 'pauli':
+            purities = histogram_pauli_subset_purities(replicas, table.q_cnt, parts)
+        else:
+            weights = bootstrap_weights(R, count, rng)
+            purities = {combo: np.sum(weights * pur, axis=-1) / R
+                        for combo, pur in histogram_subset_purities(replicas, parts).items()}
+        for combo, pur in purities.items():
+            res.setdefault(combo, []).append(pur)
+    estimates = pauli_subset_purities(table, parts) if estimator == 'pauli' else subset_purities(table, parts)
+    res = {combo: np.concatenate(pur) for combo, pur in res.items()}
+    return {combo: pur - pur.mean() + np.mean(estimates[combo]) for combo, pur in res.items()}
+
+
+def bootstrap_subset_entropies(full_counts, parts, resamples=1000, shots=True, estimator='randomized', rng=None):
+    # {tuple of part indices: array (resamples,) of second Renyi entropies}
+    purities = bootstrap_subset_purities(full_counts, parts, resamples, shots, estimator, rng)
+    return {combo: -np.log(pur) for combo, pur in purities.items()}
+
+
+def entropy_intervals(full_counts, subsystems, resamples=1000, level=0.95, shots=True, estimator='randomized',
+                      rng=None):
+    """
+    Point estimates and bootstrap confidence intervals of every subset entropy and of the topological entropy.
+
+    :param subsystems: Partition of the measured bits into A, B, C, e.g. ABC_DIVISION_2x2
+    :return: ({tuple of part indices: (entropy, low, high)}, (topological entropy, low, high)), in nats
+    """
+    estimates = subset_entropies(full_counts, subsystems, estimator)
+    replicas = bootstrap_subset_entropies(full_counts, subsystems, resamples, shots, estimator, rng)
+    subsets = {combo: (estimates[combo], *confidence_interval(replicas[combo], level)) for combo in estimates}
+    topo = (kitaev_preskill_sum(estimates), *confidence_interval(kitaev_preskill_sum(replicas), level))
+    return subsets, topo
+
+
+def jackknife_subset_entropies(full_counts, parts):
+    """
+    Leave one realization out replicas of the randomized measurement subset entropies, all at once from the sums.
+
+    :return: Dictionary {tuple of part indices: array (realizations,) of entropies}
+    """
+    res = {}
+    for combo, pur in subset_purities(full_counts, parts).items():
+        res[combo] = -np.log((pur.sum() - pur) / (len(pur) - 1))
+    return res
+
+
+def jackknife_error(replicas):
+    # standard error from leave one out replicas
+    R = len(replicas)
+    return np.sqrt((R - 1) / R * np.sum((replicas - np.mean(replicas)) ** 2))
+
+
+def jackknife_topo_entropy(full_counts, subsystems):
+    # (topological entropy, jackknife standard error), in nats
+    replicas = jackknife_subset_entropies(full_counts, subsystems)
+    estimate = kitaev_preskill_sum(subset_entropies(full_counts, subsystems))
+    return estimate, jackknife_error(kitaev_preskill_sum(replicas))
+
+
+def braiding_phase_interval(counts, resamples=1000, level=0.95, rng=None):
+    """
+    cos(theta) = p0 - p1 of the ancilla of a braiding experiment, with a binomial bootstrap of the shots.
+
+    :param counts: Dictionary {'0': count, '1': count}
+    :param resamples: Number of bootstrap replicas, at least 2 for a standard error
+    :return: (cos theta, standard error, (low, high))
+    """
+    rng = np.random.default_rng(rng)
+    n0, n1 = counts.get('0', 0), counts.get('1', 0)
+    N = n0 + n1
+    if N == 0 or resamples < 2:
+        raise ValueError(f'braiding phase of {N} shots with {resamples} resamples')
+    replicas = (2 * rng.binomial(N, n0 / N, size=resamples) - N) / N
+    return (n0 - n1) / N, np.std(replicas, ddof=1), confidence_interval(replicas, level)
+
+
+def shots_for_error(target_error, cos_theta=0.):
+    # shots for a standard error target_error of cos theta = p0 - p1, whose variance is (1 - cos^2 theta) / shots
+    return max(int(np.ceil((1 - cos_theta ** 2) / target_error ** 2)), 1)
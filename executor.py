@@ -0,0 +1,124 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from counts_table import register_counts
+
+
+def max_experiments(backend):
+    # number of circuits accepted in a single job, None if unlimited
+    limit = getattr(backend, 'max_circuits', None)  # BackendV2
+    if limit is None and hasattr(backend, 'configuration'):
+        limit = getattr(backend.configuration(), 'max_experiments', None)  # BackendV1
+    return limit
+
+
+def max_shots(backend):
+    # number of shots accepted per circuit, None if unlimited
+    limit = getattr(backend, 'max_shots', None)
+    if limit is None and hasattr(backend, 'configuration'):
+        limit = getattr(backend.configuration(), 'max_shots', None)
+    return limit
+
+
+def is_simulator(backend):
+    if hasattr(backend, 'configuration'):
+        return bool(getattr(backend.configuration(), 'simulator', False))
+    return 'simulator' in backend.name
+
+
+def is_ideal_simulator(backend):
+    # simulator without noise model, its circuits can be evaluated exactly
+    options = getattr(backend, 'options', None)
+    return is_simulator(backend) and getattr(options, 'noise_model', None) is None
+
+
+def backend_name(backend):
+    # BackendV1 has a name() method, BackendV2 a name attribute
+    return backend.name() if callable(backend.name) else backend.name
+
+
+def is_aer(backend):
+    return hasattr(backend, 'options') and hasattr(backend.options, 'max_parallel_experiments')
+
+
+def split_jobs(backend, circuits):
+    limit = max_experiments(backend) or len(circuits) or 1
+    return [circuits[i:i + limit] for i in range(0, len(circuits), limit)]
+
+
+def submit_batched(backend, circuits, shots=1024, **run_options):
+    """
+    Submits circuits in as few jobs as the backend allows, without waiting for results.
+
+    :param backend: Backend to run on
+    :param circuits: List of transpiled circuits
+    :param shots: Shots per circuit
+    :return: List of (job, circuit count)
+    """
+    if is_aer(backend):
+        run_options.setdefault('max_parallel_experiments', 0)  # let Aer parallelize across experiments
+    return [(backend.run(chunk, shots=shots, **run_options), len(chunk)) for chunk in split_jobs(backend, circuits)]
+
+
+def collect_counts(jobs, memory=False, register=None):
+    # counts (or per-shot memory) of every circuit, in the order of submission, optionally of one register only
+    all_counts = []
+    for job, count in jobs:
+        result = job.result()
+        for i in range(count):
+            if memory:
+                shots = result.get_memory(i)
+                all_counts.append(shots if register is None else [s.split(' ')[register] for s in shots])
+            else:
+                counts = result.get_counts(i)
+                all_counts.append(counts if register is None else register_counts(counts, register))
+    return all_counts
+
+
+def run_batched(backend, circuits, shots=1024, memory=False, register=None, **run_options):
+    """
+    Runs circuits in chunks of at most max_experiments per job and maps the results back.
+
+    :param register: Keep only this classical register, see register_counts, e.g. 0 for the readout register of
+        a toric code prepared with preparation='measured'
+    :return: List of counts, one per circuit, in the order of circuits
+    """
+    if memory:
+        run_options['memory'] = True
+    return collect_counts(submit_batched(backend, circuits, shots, **run_options), memory, register)
+
+
+def run_pipelined(backend, tasks, shots=1024, max_in_flight=2, **run_options):
+    """
+    Overlaps building and transpiling of the next batch with execution of the current one,
+    and post-processes every batch as soon as its results land.
+
+    :param backend: Backend to run on
+    :param tasks: Iterable of (prepare, process) pairs. prepare() returns a list of transpiled circuits,
+        process(all_counts) turns their counts into a result
+    :param shots: Shots per circuit
+    :param max_in_flight: Maximum number of batches prepared or running but not yet collected, and of processed
+        results not yet consumed, caps memory
+    :return: Generator of process results, in the order of tasks
+    """
+
+    def prepare_and_submit(prepare):
+        return submit_batched(backend, prepare(), shots, **run_options)
+
+    # single workers keep preparation and post-processing in task order
+    with ThreadPoolExecutor(max_workers=1) as prepare_pool, ThreadPoolExecutor(max_workers=1) as process_pool:
+        in_flight, processing = deque(), deque()
+        for prepare, process in tasks:
+            in_flight.append((prepare_pool.submit(prepare_and_submit, prepare), process))
+            if len(in_flight) < max_in_flight:
+                continue
+            jobs, done_process = in_flight.popleft()
+            processing.append(process_pool.submit(done_process, collect_counts(jobs.result())))
+            # results wait for the consumer only up to the same bound
+            while processing and (processing[0].done() or len(processing) >= max_in_flight):
+                yield processing.popleft().result()
+        while in_flight:
+            jobs, process = in_flight.popleft()
+            processing.append(process_pool.submit(process, collect_counts(jobs.result())))
+        while processing:
+            yield processing.popleft().result()
@@ -0,0 +1,42 @@
+from counts_table import CountsTable
+from executor import run_batched
+from lattice_index import get_lattice_index
+from placement_groups import group_circuits
+from topo_entropy import calculate_s_topo
+from toric_code_matching import sample_haar_angles
+
+
+def lattice_qubits(size):
+    # every lattice qubit, in the order of the circuit qubits
+    return list(map(tuple, get_lattice_index(*size).coords.tolist()))
+
+
+def collect_lattice_dataset(backend, size, cnt=100, shots=1024, rng=None):
+    """
+    Measures every qubit of the lattice in an independent Haar random basis, cnt realizations.
+    Entropies of any subsystem are then obtained by post-processing, see dataset_counts.
+
+    :return: CountsTable with qubit j of lattice_qubits(size) in classical bit j, and the angles as settings
+    """
+    qubits = lattice_qubits(size)
+    angles = sample_haar_angles((cnt, len(qubits)), rng)
+    circuits = group_circuits(backend, size, [qubits], angles)
+    return CountsTable.from_counts(run_batched(backend, circuits, shots=shots), angles)
+
+
+def dataset_counts(dataset, size, qubits):
+    # counts of the subsystem, in the same format as if only qubits were measured (character i is qubits[-1 - i])
+    index = get_lattice_index(*size).flat_index(qubits)
+    sub_idx = (dataset.q_cnt - 1 - index[::-1]).tolist()
+    table = dataset.marginal(sub_idx)
+    table.settings = dataset.settings[:, index]
+    return table
+
+
+def dataset_topo_entropy(dataset, size, qubits, subsystems):
+    return calculate_s_topo(dataset_counts(dataset, size, qubits), subsystems)
+
+
+def dataset_topo_entropy_map(dataset, size, placements, subsystems):
+    # {placement: topological entropy} for placements from get_all_*_non_corner, without running any circuit
+    return {tuple(qubits): dataset_topo_entropy(dataset, size, qubits, subsystems) for qubits in placements}
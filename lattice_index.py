@@ -0,0 +1,107 @@
+import numpy as np
+
+# offsets (row, col) of the qubits of a plaquette from its representative (2x, y), and of a star from its vertex (2x, y)
+PLAQUETTE_OFFSETS = ((0, 0), (1, 0), (1, 1), (2, 0))
+STAR_OFFSETS = ((-1, 0), (0, -1), (0, 0), (1, 0))
+
+# lattice indices shared by all modules, keyed by (x, y, boundary_condition)
+_indices = {}
+
+
+def get_lattice_index(x, y, boundary_condition='matching'):
+    key = (x, y, boundary_condition)
+    if key not in _indices:
+        _indices[key] = LatticeIndex(x, y, boundary_condition)
+    return _indices[key]
+
+
+class LatticeIndex:
+    def __init__(self, x, y, boundary_condition='matching'):
+        """
+        Geometry of the lattice as arrays, built once per lattice, see get_lattice_index.
+        Coordinates are (row, col) on a (y, x) grid. With matching boundary condition even rows are horizontal edges
+        and have one qubit less, odd rows are vertical edges.
+
+        :param x: Column count
+        :param y: Row count
+        """
+        assert boundary_condition == 'matching', 'only the matching boundary condition has a geometry'
+        self.x, self.y = x, y
+        self.row_sizes = np.where(np.arange(y) % 2 == 0, x - 1, x)
+        self.inside = np.arange(x)[None, :] < self.row_sizes[:, None]
+        # coordinates of every qubit in circuit order, row by row, and their position in it (-1 off the lattice)
+        self.coords = np.argwhere(self.inside)
+        self.flat = np.full((y, x), -1)
+        self.flat[self.inside] = np.arange(len(self.coords))
+
+        self.corner = np.zeros((y, x), dtype=bool)
+        self.corner[np.ix_([0, y - 1], [0, x - 2])] = True
+        self.corner[np.ix_([1, y - 2], [0, x - 1])] = True
+        self.corner &= self.inside
+        # qubits of the boundary: the first and last rows, and the outer vertical edges
+        self.boundary = np.zeros((y, x), dtype=bool)
+        self.boundary[[0, y - 1]] = True
+        self.boundary[1::2, [0, x - 1]] = True
+        self.boundary &= self.inside
+
+        # flat indices of the support of every stabilizer, -1 padded where boundary stars have fewer qubits
+        self.plaquettes = self.supports((y // 2, x - 1), PLAQUETTE_OFFSETS)
+        self.stars = self.supports((y // 2 + 1, x), STAR_OFFSETS)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def contains(self, coords):
+        # mask of the coordinates (..., 2) on the lattice
+        coords = np.asarray(coords)
+        r, c = coords[..., 0], coords[..., 1]
+        on_grid = (r >= 0) & (r < self.y) & (c >= 0) & (c < self.x)
+        return on_grid & self.inside[np.where(on_grid, r, 0), np.where(on_grid, c, 0)]
+
+    def is_corner(self, coords):
+        # mask of the coordinates (..., 2) on a corner qubit
+        coords = np.asarray(coords)
+        on_lattice = self.contains(coords)
+        rows, cols = np.where(on_lattice, coords[..., 0], 0), np.where(on_lattice, coords[..., 1], 0)
+        return on_lattice & self.corner[rows, cols]
+
+    def flat_index(self, coords):
+        # position in circuit order of the coordinates (..., 2), -1 off the lattice
+        coords = np.asarray(coords)
+        on_lattice = self.contains(coords)
+        return np.where(on_lattice, self.flat[np.where(on_lattice, coords[..., 0], 0),
+                                              np.where(on_lattice, coords[..., 1], 0)], -1)
+
+    def supports(self, shape, offsets):
+        # array (*shape, len(offsets)) of flat indices of the qubits at offsets from (2x, y)
+        rows, cols = np.meshgrid(2 * np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+        return self.flat_index(np.stack((rows, cols), axis=-1)[..., None, :] + np.array(offsets))
+
+    def support_matrix(self, kind):
+        """
+        :param kind: 'plaquette' or 'star'
+        :return: Boolean array (rows, cols, qubits), True on the qubits of every stabilizer
+        """
+        assert kind in ('plaquette', 'star')
+        supports = self.plaquettes if kind == 'plaquette' else self.stars
+        mat = np.zeros((*supports.shape[:-1], len(self) + 1), dtype=bool)
+        np.put_along_axis(mat, np.where(supports < 0, len(self), supports), True, axis=-1)
+        return mat[..., :-1]
+
+    def placements(self, shape, corners=False):
+        """
+        Every placement of a subsystem shape, in the order of the anchor qubit row by row.
+
+        :param shape: Offsets (row, col) of the qubits from the anchor, one list for anchors on even rows and
+            one for anchors on odd rows, None for no placement on that parity
+        :param corners: Keep the placements containing a corner qubit
+        :return: Array (placements, qubits, 2) of coordinates
+        """
+        size = len(next(offsets for offsets in shape if offsets is not None))
+        offsets = np.array([np.zeros((size, 2), dtype=int) if o is None else o for o in shape])
+        rows, cols = np.divmod(np.arange(self.y * self.x), self.x)
+        coords = np.stack((rows, cols), axis=-1)[:, None, :] + offsets[rows % 2]
+        keep = np.array([o is not None for o in shape])[rows % 2] & self.contains(coords).all(axis=-1)
+        if not corners:
+            keep &= ~self.is_corner(coords).any(axis=-1)
+        return coords[keep]
@@ -0,0 +1,91 @@
+from qiskit import transpile
+from qiskit.transpiler import CouplingMap, PassManager
+from qiskit.transpiler.passes import VF2Layout
+
+from executor import is_simulator
+from toric_code import get_toric_code
+
+# physical qubit of every circuit qubit, keyed by (coupling map edges, interaction graph edges, qubit count)
+_layouts = {}
+
+
+def coupling_map(backend):
+    # None for backends without connectivity constraints, e.g. Aer
+    cmap = getattr(backend, 'coupling_map', None)  # BackendV2
+    if cmap is None and hasattr(backend, 'configuration'):
+        edges = getattr(backend.configuration(), 'coupling_map', None)  # BackendV1
+        cmap = CouplingMap(edges) if edges else None
+    return cmap
+
+
+def interaction_edges(circ):
+    # pairs of qubit indices acting together in a gate
+    index = {q: i for i, q in enumerate(circ.qubits)}
+    return frozenset(tuple(sorted(index[q] for q in inst.qubits)) for inst in circ.data
+                     if len(inst.qubits) == 2 and inst.operation.name != 'barrier')
+
+
+def two_qubit_count(circ):
+    return sum(1 for inst in circ.data if len(inst.qubits) == 2 and inst.operation.name != 'barrier')
+
+
+def find_layout(circ, backend, seeds=16):
+    """
+    Physical qubit of every qubit of circ, minimizing the inserted SWAPs.
+    An embedding of the interaction graph found by VF2 needs no SWAP at all, otherwise the best of several
+    Sabre seeds by two-qubit gate count, then depth, is kept.
+
+    :param seeds: Number of Sabre seeds tried
+    :return: List, physical qubit of circ.qubits[i]
+    """
+    pm = PassManager([VF2Layout(coupling_map(backend), seed=0, call_limit=10 ** 7, strict_direction=False)])
+    pm.run(circ)
+    layout = pm.property_set['layout']
+    if layout is not None:
+        return [layout[q] for q in circ.qubits]
+
+    best = None
+    for seed in range(seeds):
+        transpiled = transpile(circ, backend, layout_method='sabre', optimization_level=1, seed_transpiler=seed)
+        score = (two_qubit_count(transpiled), transpiled.depth())
+        if best is None or score < best[0]:
+            best = score, [transpiled.layout.initial_layout[q] for q in circ.qubits]
+    return best[1]
+
+
+def lattice_layout(backend, tc, circ=None, seeds=16):
+    """
+    Layout of the toric code on the backend, computed once per coupling map and interaction graph.
+
+    :param circ: Circuit whose interactions are embedded, the ground state preparation of tc by default.
+        Circuits with ancillas interacting with the lattice, e.g. braiding, should pass the full circuit
+    :return: Dictionary {qubit: physical qubit}, None for backends without coupling map
+    """
+    cmap = coupling_map(backend)
+    if cmap is None or is_simulator(backend):
+        return None
+    if circ is None:
+        circ = tc.ground_state
+    key = (frozenset(cmap.get_edges()), interaction_edges(circ), circ.num_qubits)
+    if key not in _layouts:
+        _layouts[key] = find_layout(circ, backend, seeds)
+    return dict(zip(circ.qubits, _layouts[key]))
+
+
+def transpile_on_lattice(circ, backend, tc, layout_circ=None, **transpile_options):
+    # transpile with the cached lattice layout as initial_layout, circ may be pruned to a subset of the qubits
+    layout = lattice_layout(backend, tc, layout_circ)
+    if layout is not None:
+        transpile_options['initial_layout'] = [layout[q] for q in circ.qubits]
+    return transpile(circ, backend, **transpile_options)
+
+
+def layout_report(backend, sizes, seed=0):
+    # [(size, two-qubit gates default, with layout, depth default, with layout)] of the ground state preparation
+    report = []
+    for x, y in sizes:
+        tc = get_toric_code(x, y)
+        default = transpile(tc.ground_state, backend, optimization_level=1, seed_transpiler=seed)
+        cached = transpile_on_lattice(tc.ground_state, backend, tc, optimization_level=1, seed_transpiler=seed)
+        report.append(((x, y), two_qubit_count(default), two_qubit_count(cached), default.depth(), cached.depth()))
+    return report
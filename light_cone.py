@@ -0,0 +1,50 @@
+from qiskit import QuantumCircuit
+
+
+def light_cone_instructions(circ):
+    """
+    Backward causal cone of the measurements of circ.
+    Every measurement is kept, and a gate is kept if it acts on a qubit that can still influence a kept measurement.
+
+    :return: (kept instructions in circuit order, qubits of the cone)
+    """
+    cone, kept = set(), []
+    for inst in reversed(circ.data):
+        name = inst.operation.name
+        qubits = set(inst.qubits)
+        if name == 'measure':
+            cone |= qubits
+            kept.append(inst)
+        elif name == 'barrier':
+            kept.append(inst)
+        elif name == 'reset':
+            # history before a reset does not matter
+            if qubits & cone:
+                kept.append(inst)
+                cone -= qubits
+        elif qubits & cone:
+            cone |= qubits
+            kept.append(inst)
+    # qubits reset inside the cone are still acted on
+    used = {q for inst in kept if inst.operation.name != 'barrier' for q in inst.qubits}
+    return kept[::-1], used
+
+
+def prune_to_light_cone(circ):
+    """
+    Reduced circuit acting only on the qubits that can influence the measured outcomes.
+    The marginal distribution of the measured classical bits is unchanged, and classical registers are kept,
+    so counts have the same format as for circ.
+    """
+    kept, used = light_cone_instructions(circ)
+    qubits = [q for q in circ.qubits if q in used]
+    pruned = QuantumCircuit(*circ.cregs, name=circ.name, global_phase=circ.global_phase)
+    pruned.add_bits(qubits)
+    for inst in kept:
+        if inst.operation.name == 'barrier':
+            inst_qubits = [q for q in inst.qubits if q in used]
+            if inst_qubits:
+                pruned.barrier(inst_qubits)
+            continue
+        pruned.append(inst)
+    return pruned
@@ -1,9 +1,12 @@
+from functools import partial
+
 import numpy as np
 from qiskit import Aer
 from qiskit import IBMQ
 
+from executor import run_pipelined
 from topo_braiding import em_braiding_phase
-from topo_entropy import calculate_topo_entropy_pauli, calculate_topo_entropy_haar
+from topo_entropy import calculate_s_topo, haar_tomography_circuits, pauli_tomography_circuits
 from toric_code import get_toric_code
 from toric_code_matching import get_plaquette_matching
 
@@ -25,18 +28,26 @@ provider = IBMQ.get_provider(hub='ibm-q-sherbrooke', group='udes', project='quic
 backend_hardware = provider.get_backend('ibm_washington')
 backend = backend_hardware
 
-theta_em, err_theta_em = em_braiding_phase(backend, x, y)
+theta_em, err_theta_em, (low_theta_em, high_theta_em) = em_braiding_phase(backend, x, y)
 
-print('theta_em = {:.3f} +/- {:.3f}'.format(theta_em, err_theta_em))
+print('theta_em = {:.3f} +/- {:.3f}, 95% interval [{:.3f}, {:.3f}]'.format(theta_em, err_theta_em, low_theta_em,
+                                                                           high_theta_em))
 
 abc_2x2 = [(0, 1), (2,), (3,)]
+tasks, labels = [], []
 for i in range(px):
     for j in range(py):
         if i in (0, px - 1) or j in (0, py - 1):
             continue
         plaq = get_plaquette_matching(j, i)
-        print(plaq)
-        topo_ent = calculate_topo_entropy_pauli(backend, (x, y), plaq, abc_2x2)
-        print('topo entropy', topo_ent / np.log(2))
-        topo_ent = calculate_topo_entropy_haar(backend, (x, y), plaq, abc_2x2)
-        print('topo entropy', topo_ent / np.log(2))
+        tasks.append((partial(pauli_tomography_circuits, backend, (x, y), plaq),
+                      partial(calculate_s_topo, subsystems=abc_2x2, estimator='pauli')))
+        labels.append((plaq, 'pauli'))
+        tasks.append((partial(haar_tomography_circuits, backend, (x, y), plaq),
+                      partial(calculate_s_topo, subsystems=abc_2x2)))
+        labels.append((plaq, 'haar'))
+
+# building and transpiling the next placement overlaps with the execution of the current one
+for (plaq, kind), topo_ent in zip(labels, run_pipelined(backend, tasks, shots=1024)):
+    print(plaq, kind)
+    print('topo entropy', topo_ent / np.log(2))
@@ -0,0 +1,116 @@
+import os
+from contextlib import contextmanager
+from multiprocessing import get_context
+
+import numpy as np
+from qiskit import Aer
+
+from counts_table import CountsTable
+from executor import run_batched
+from topo_entropy import haar_tomography_circuits, pauli_tomography_angles, pauli_tomography_circuits
+from topo_entropy import kitaev_preskill_sum, subset_entropies, subset_purities
+from toric_code_matching import sample_haar_angles, spawn_generators
+
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+_backend = None
+
+
+@contextmanager
+def _thread_environment(threads):
+    # thread limits of OpenMP and BLAS are read once, when numpy and Aer are loaded in a new worker
+    previous = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+    os.environ.update({variable: str(threads) for variable in THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for variable, value in previous.items():
+            if value is None:
+                del os.environ[variable]
+            else:
+                os.environ[variable] = value
+
+
+def _init_worker(threads, backend_options):
+    # one simulator per worker, every worker limited to its share of the cores
+    global _backend
+    _backend = Aer.get_backend('aer_simulator')
+    _backend.set_options(max_parallel_threads=threads, max_parallel_experiments=1, max_parallel_shots=1,
+                         **backend_options)
+
+
+def _run_task(task):
+    """
+    Runs the settings of one placement and post-processes them in the worker.
+
+    :return: subset entropies of Pauli tomography, or per realization subset purities of Haar settings,
+        which are additive over tasks of the same placement
+    """
+    size, qubits, subsystems, kind, angles, shots, seed = task
+    circuits = pauli_tomography_circuits if kind == 'pauli' else haar_tomography_circuits
+    all_counts = run_batched(_backend, circuits(_backend, size, qubits, angles=angles), shots=shots,
+                             max_parallel_experiments=1, seed_simulator=seed)
+    table = CountsTable.from_counts(all_counts, angles)
+    if kind == 'pauli':
+        return subset_entropies(table, subsystems, 'pauli')
+    return subset_purities(table, subsystems)
+
+
+def sweep_tasks(size, placements, subsystems, kind='haar', cnt=100, shots=1024, tasks_per_placement=1, seed=None):
+    """
+    Splits a sweep into independent tasks, Haar settings of a placement can be split over several tasks.
+    Complete Pauli tomography needs all settings together, so it is one task per placement.
+
+    :return: List of (placement index, task)
+    """
+    assert kind in ('haar', 'pauli')
+    rngs = spawn_generators(seed, len(placements))
+    tasks = []
+    for i, (qubits, rng) in enumerate(zip(placements, rngs)):
+        if kind == 'pauli':
+            chunks = [pauli_tomography_angles(len(qubits))]
+        else:
+            chunks = np.array_split(sample_haar_angles((cnt, len(qubits)), rng), min(tasks_per_placement, cnt))
+        for angles in chunks:
+            tasks.append((i, (size, qubits, subsystems, kind, angles, shots, int(rng.integers(2 ** 31)))))
+    return tasks
+
+
+def parallel_topo_entropy_map(size, placements, subsystems, kind='haar', cnt=100, shots=1024, processes=None,
+                              threads_per_worker=None, seed=None, **backend_options):
+    """
+    Topological entropy of every placement, simulated on a pool of processes with one Aer simulator each.
+    Workers are given cores // processes threads, so simulator and numpy threads do not oversubscribe the node.
+    Workers are spawned rather than forked, so that they load numpy with these limits instead of inheriting
+    the thread pools of the parent.
+
+    :param placements: List of placements, e.g. from get_all_2x2_non_corner
+    :param kind: 'haar' for cnt randomized settings, 'pauli' for complete Pauli tomography
+    :param processes: Number of workers, defaults to the number of cores
+    :param seed: Seed of the Haar angles and of the simulators
+    :param backend_options: Options of every AerSimulator, e.g. method='statevector'
+    :return: Dictionary {placement: topological entropy}
+    """
+    if not len(placements):
+        return {}
+    cores = os.cpu_count() or 1
+    processes = processes or cores
+    threads = threads_per_worker or max(cores // processes, 1)
+    # splitting Haar settings keeps every worker busy when there are fewer placements than workers
+    tasks = sweep_tasks(size, placements, subsystems, kind, cnt, shots, -(-processes // len(placements)), seed)
+
+    with _thread_environment(threads), get_context('spawn').Pool(processes, _init_worker,
+                                                                  (threads, backend_options)) as pool:
+        results = pool.map(_run_task, [task for _, task in tasks], chunksize=1)
+
+    per_placement = [[] for _ in placements]
+    for (i, _), res in zip(tasks, results):
+        per_placement[i].append(res)
+    topo_map = {}
+    for qubits, parts in zip(placements, per_placement):
+        if kind == 'pauli':
+            entropies, = parts
+        else:
+            entropies = {combo: -np.log(np.mean(np.concatenate([p[combo] for p in parts]))) for combo in parts[0]}
+        topo_map[tuple(qubits)] = kitaev_preskill_sum(entropies)
+    return topo_map
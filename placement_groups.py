@@ -0,0 +1,88 @@
+import numpy as np
+from tqdm import tqdm
+
+from counts_table import CountsTable
+from executor import run_batched
+from topo_entropy import pauli_tomography_angles, tomography_circuit
+from toric_code import get_toric_code
+from toric_code_matching import sample_haar_angles
+
+
+def group_placements(placements):
+    """
+    Greedy coloring of placements into groups of pairwise disjoint placements, which can be measured in the same shot.
+
+    :param placements: List of placements, e.g. from get_all_2x2_non_corner
+    :return: List of groups, every group is a list of indices into placements
+    """
+    groups, group_qubits = [], []
+    for i, qubits in enumerate(placements):
+        for group, used in zip(groups, group_qubits):
+            if used.isdisjoint(qubits):
+                group.append(i)
+                used.update(qubits)
+                break
+        else:
+            groups.append([i])
+            group_qubits.append(set(qubits))
+    return groups
+
+
+def group_circuits(backend, size, placements, angles, light_cone=None):
+    """
+    One circuit per setting measuring all placements of a group simultaneously.
+    Placement p is measured into the classical bits following those of placements 0..p-1.
+
+    :param angles: Array (settings, total qubit count, 3) of u angles, placements concatenated in order
+    """
+    x, y = size
+    qubits = [q for placement in placements for q in placement]
+    tc = get_toric_code(x, y, len(qubits))
+    tc.measure_parameterized(qubits)
+    circ = tomography_circuit(backend, tc, light_cone)
+    return [tc.bind_measurement(circ, setting) for setting in tqdm(angles)]
+
+
+def split_group_counts(table, sizes):
+    # per placement counts, as if every placement was measured alone into classical bits 0..size - 1
+    tables, offset = [], 0
+    for size in sizes:
+        # classical bit j is character q_cnt - 1 - j of the bitstring
+        sub_table = table.marginal(range(table.q_cnt - offset - size, table.q_cnt - offset))
+        if table.settings is not None:
+            sub_table.settings = table.settings[:, offset:offset + size]
+        tables.append(sub_table)
+        offset += size
+    return tables
+
+
+def grouped_tomography(backend, size, placements, all_angles, shots=1024, light_cone=None):
+    """
+
+    :param all_angles: Function (group placements) -> array (settings, total qubit count, 3)
+    :return: List of CountsTable, one per placement, in the order of placements
+    """
+    tables = [None] * len(placements)
+    for group in group_placements(placements):
+        group_placement = [placements[i] for i in group]
+        angles = all_angles(group_placement)
+        circuits = group_circuits(backend, size, group_placement, angles, light_cone)
+        table = CountsTable.from_counts(run_batched(backend, circuits, shots=shots), angles)
+        for i, sub_table in zip(group, split_group_counts(table, [len(p) for p in group_placement])):
+            tables[i] = sub_table
+    return tables
+
+
+def grouped_pauli_tomography(backend, size, placements, shots=1024, light_cone=None):
+    # setting s measures every placement of a group in its own Pauli setting s, placements must have equal size
+    assert len({len(p) for p in placements}) == 1
+    return grouped_tomography(backend, size, placements,
+                              lambda group: np.concatenate([pauli_tomography_angles(len(p)) for p in group], axis=1),
+                              shots, light_cone)
+
+
+def grouped_haar_tomography(backend, size, placements, cnt=100, shots=1024, rng=None, light_cone=None):
+    rng = np.random.default_rng(rng)
+    return grouped_tomography(backend, size, placements,
+                              lambda group: sample_haar_angles((cnt, sum(len(p) for p in group)), rng),
+                              shots, light_cone)
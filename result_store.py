@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+
+from counts_table import CountsTable
+from executor import backend_name, max_experiments, run_batched
+
+
+def setting_key(size, qubits, setting, shots, backend, boundary_condition='matching'):
+    """
+    Content hash of one measurement setting, equal for equal experiments on the same backend.
+
+    :param setting: u angles (qubits, 3) of the measured qubits
+    :return: Hex digest
+    """
+    description = {
+        'size': [int(s) for s in size],
+        'boundary_condition': boundary_condition,
+        'qubits': [[int(c) for c in q] for q in qubits],
+        'setting': np.round(np.asarray(setting, dtype=float), 12).tolist(),
+        'shots': int(shots),
+        'backend': backend_name(backend),
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class ResultStore:
+    def __init__(self, root):
+        """
+        Counts of single settings on disk, addressed by setting_key.
+        Every put writes a run directory of .npy arrays, so runs are memory-mapped when loaded and nothing is read
+        before it is needed. Runs are written to a hidden directory and renamed, a crash never leaves a partial run.
+
+        :param root: Directory of the store, created if missing
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._index = {}  # key: (run, row)
+        self._tables = {}  # run: memory-mapped CountsTable
+        for run in sorted(os.listdir(root)):
+            if not run.startswith('.'):
+                self._index_run(run)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def _index_run(self, run):
+        for row, key in enumerate(np.load(os.path.join(self.root, run, 'keys.npy'))):
+            self._index[str(key)] = (run, row)
+
+    def missing(self, keys):
+        # positions of the keys not in the store
+        return [i for i, key in enumerate(keys) if key not in self]
+
+    def put(self, keys, table):
+        # stores realization i of table under keys[i]
+        assert len(keys) == len(table)
+        run = uuid.uuid4().hex
+        tmp = os.path.join(self.root, '.' + run)
+        os.makedirs(tmp)
+        arrays = {'keys': np.array(keys, dtype='U64'), 'outcomes': table.outcomes, 'counts': table.counts,
+                  'offsets': table.offsets, 'q_cnt': np.array(table.q_cnt)}
+        if table.settings is not None:
+            arrays['settings'] = table.settings
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), arr)
+        os.rename(tmp, os.path.join(self.root, run))
+        self._index_run(run)
+
+    def runs(self):
+        return sorted({run for run, _ in self._index.values()})
+
+    def load_run(self, run):
+        # CountsTable of every setting of a run, backed by memory-mapped arrays
+        if run not in self._tables:
+            path = os.path.join(self.root, run)
+            arrays = {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+                      for name in os.listdir(path) if name != 'q_cnt.npy'}
+            self._tables[run] = CountsTable(arrays['outcomes'], arrays['counts'], arrays['offsets'],
+                                            int(np.load(os.path.join(path, 'q_cnt.npy'))), arrays.get('settings'))
+        return self._tables[run]
+
+    def get(self, keys):
+        # CountsTable of the keys in order, only their realizations are read from disk
+        locations = [self._index[key] for key in keys]
+        tables, start = [], 0
+        for i in range(1, len(locations) + 1):
+            if i == len(locations) or locations[i][0] != locations[start][0]:
+                rows = [row for _, row in locations[start:i]]
+                tables.append(self.load_run(locations[start][0])[rows])
+                start = i
+        return CountsTable.concatenate(tables)
+
+
+def run_stored(store, backend, circuits, keys, settings, shots=1024, chunk_size=None):
+    """
+    Counts of every setting, running only the settings missing from store.
+    Missing settings run in chunks, and every chunk is stored as soon as its results land.
+
+    :param circuits: Function (array of settings) -> list of transpiled circuits
+    :param keys: setting_key of every setting
+    :param settings: Array of settings, along the first axis
+    :param chunk_size: Settings per chunk, defaults to the backend job size
+    :return: CountsTable with the settings of keys, in order
+    """
+    settings = np.asarray(settings)
+    missing = store.missing(keys)
+    chunk_size = chunk_size or max_experiments(backend) or len(missing) or 1
+    for start in range(0, len(missing), chunk_size):
+        idx = missing[start:start + chunk_size]
+        all_counts = run_batched(backend, circuits(settings[idx]), shots=shots)
+        store.put([keys[i] for i in idx], CountsTable.from_counts(all_counts, settings[idx]))
+    return store.get(keys)
@@ -0,0 +1,87 @@
+import numpy as np
+
+from anyon_paths import apply_string_operator, frame_flips
+from executor import run_batched
+from lattice_index import get_lattice_index
+from layout import transpile_on_lattice
+from toric_code import get_toric_code
+
+
+def stabilizer_matrix(tc, kind):
+    """
+    Support of every plaquette (X) or star (Z) stabilizer, columns are lattice qubits in measure_lattice order.
+
+    :param kind: 'plaquette' or 'star'
+    :return: Boolean array (rows, cols, lattice qubits), plaquettes (plaquette_y, plaquette_x),
+        stars (star_y, star_x)
+    """
+    return get_lattice_index(tc.x, tc.y).support_matrix(kind)
+
+
+def outcome_bits(outcomes):
+    # array (outcomes, bits) of 0 and 1, column j is classical bit j, i.e. character -1 - j of the bitstring
+    bits = np.frombuffer(''.join(outcomes).encode(), dtype=np.uint8).reshape(len(outcomes), -1)
+    return bits[:, ::-1] - ord('0')
+
+
+def syndromes(outcomes, mat, flips=()):
+    """
+    Parity of every stabilizer of mat in every outcome.
+
+    :param flips: Classical bits flipped by a Pauli frame, see anyon_paths.frame_flips
+    :return: Boolean array (outcomes, rows, cols), True where the stabilizer has parity -1
+    """
+    bits = outcome_bits(outcomes)
+    bits[:, list(flips)] ^= 1
+    return (bits @ mat.reshape(-1, mat.shape[-1]).T.astype(np.int64) % 2).astype(bool).reshape(len(bits),
+                                                                                                 *mat.shape[:-1])
+
+
+def stabilizer_expectations(counts, mat, flips=()):
+    # array (rows, cols) of <S> of every stabilizer of mat, from counts of the lattice measured in its basis
+    outcomes = list(counts)
+    weights = np.array([counts[o] for o in outcomes], dtype=float)
+    signs = 1 - 2 * syndromes(outcomes, mat, flips)
+    return np.tensordot(weights, signs, axes=1) / weights.sum()
+
+
+def readout_circuits(backend, size, paulis=None, preparation='unitary'):
+    """
+    Lattice measured in the X basis, for the plaquettes, and in the Z basis, for the stars.
+
+    :param paulis: Optional Pauli product applied to the ground state, e.g. from string_operator.
+        It is kept in the Pauli frame of the returned toric codes, see anyon_paths.apply_frame
+    :return: (transpiled circuits, toric codes), X basis first
+    """
+    x, y = size
+    circuits, tcs = [], []
+    for basis in ('x', 'z'):
+        tc = get_toric_code(x, y, classical_bit_count=len(get_lattice_index(x, y)), preparation=preparation)
+        if paulis:
+            apply_string_operator(tc, paulis)
+        tc.measure_lattice(basis)
+        circuits.append(transpile_on_lattice(tc.circ, backend, tc))
+        tcs.append(tc)
+    return circuits, tcs
+
+
+def measure_stabilizers(backend, size, shots=1024, paulis=None, preparation='unitary', memory=False):
+    """
+    Every plaquette and star of the lattice from the two circuits of readout_circuits, run in one batch.
+
+    :param memory: Return the syndrome of every shot instead of the expectations
+    :return: (plaquettes, stars), arrays (rows, cols) of expectations, or with memory=True boolean arrays
+        (shots, rows, cols), True where the stabilizer is violated
+    """
+    circuits, tcs = readout_circuits(backend, size, paulis, preparation)
+    # the readout register is the one added last, see register_counts
+    results = run_batched(backend, circuits, shots=shots, memory=memory, register=0)
+    res = []
+    for kind, tc, result in zip(('plaquette', 'star'), tcs, results):
+        mat = stabilizer_matrix(tc, kind)
+        flips = frame_flips(tc, tc.c_reg)
+        if memory:
+            res.append(syndromes(result, mat, flips))
+        else:
+            res.append(stabilizer_expectations(result, mat, flips))
+    return tuple(res)
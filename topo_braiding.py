@@ -1,13 +1,45 @@
 import numpy as np
-from qiskit import transpile
-
+from qiskit import QuantumCircuit
+from qiskit.quantum_info import Pauli, StabilizerState
+
+from anyon_paths import apply_frame, apply_string_operator, frame_flips, string_operator
+from error_bars import braiding_phase_interval, shots_for_error
+from executor import is_ideal_simulator, is_simulator, max_shots, run_batched
+from lattice_index import get_lattice_index
+from layout import transpile_on_lattice
+from light_cone import prune_to_light_cone
 from toric_code import get_toric_code
-from toric_code_matching import is_inside_matching
 
-sz = np.array([[1, 0], [0, -1]])
-sx = np.array([[0, 1], [1, 0]])
-sy = np.array([[0, 1.0j], [-1.0j, 0]])
-s0 = np.eye(2)
+# controlled Pauli gates shared by all circuits, keyed by (Pauli string, control state)
+_controlled_paulis = {}
+
+
+def controlled_pauli_gate(paulis, ctrl_state=0):
+    """
+    Pauli string on the first qubits, applied if the last qubit (the ancilla) is in ctrl_state.
+    Y = iXZ, so the string is a cz and a cx from the ancilla per qubit and a phase i^(y count) on the ancilla.
+    The gate is Clifford and needs no unitary synthesis, so braiding circuits transpile to native gates directly.
+
+    :param paulis: Pauli of every qubit, e.g. 'xxyyzz'
+    """
+    key = (paulis, ctrl_state)
+    if key not in _controlled_paulis:
+        circ = QuantumCircuit(len(paulis) + 1, name=f'c{paulis}')
+        anc = len(paulis)
+        if ctrl_state == 0:
+            circ.x(anc)
+        for q, pauli in enumerate(paulis):
+            if pauli in 'yz':
+                circ.cz(anc, q)
+        for q, pauli in enumerate(paulis):
+            if pauli in 'xy':
+                circ.cx(anc, q)
+        for gate in [[], ['s'], ['z'], ['sdg']][paulis.count('y') % 4]:
+            getattr(circ, gate)(anc)
+        if ctrl_state == 0:
+            circ.x(anc)
+        _controlled_paulis[key] = circ.to_gate()
+    return _controlled_paulis[key]
 
 
 def create_e_particles(tc, string):
@@ -27,30 +59,27 @@ def apply_cxxxx_on_square(tc, upper_corner):
     else:
         locs = [(x, y), (x + 1, y - 1), (x + 2, y), (x + 1, y)]
 
-    if not all([is_inside_matching((tc.x, tc.y), l) for l in locs]):
+    if not get_lattice_index(tc.x, tc.y).contains(locs).all():
         return
     tc.circ.mct(control_qubits=[tc.ancillas[0]], target_qubit=[tc.regs[l[0]][l[1]] for l in locs])
 
 
 def apply_czzz_on_square(tc, upper_corner):
-    cZZZZ = np.kron(np.array([[1, 0], [0, 0]]), np.kron(sz, np.kron(sz, np.kron(sz, sz)))) + \
-            np.kron(np.array([[0, 0], [0, 1]]), np.kron(s0, np.kron(s0, np.kron(s0, s0))))
+    # ZZZZ on the square if the ancilla is |0>
     x, y = upper_corner
     if x % 2 == 0:
         locs = [(x, y), (x + 1, y), (x + 2, y), (x + 1, y + 1)]
     else:
         locs = [(x, y), (x + 1, y - 1), (x + 2, y), (x + 1, y)]
 
-    if not all([is_inside_matching((tc.x, tc.y), l) for l in locs]):
+    if not get_lattice_index(tc.x, tc.y).contains(locs).all():
         return
 
-    tc.circ.unitary(cZZZZ, [tc.regs[l[0]][l[1]] for l in locs] + [tc.ancillas[0]])
+    tc.circ.append(controlled_pauli_gate('zzzz'), [tc.regs[l[0]][l[1]] for l in locs] + [tc.ancillas[0]])
 
 
 def apply_cxxyyzz_on_rectangle(tc, upper_corner, left=True):
-    cXXYYZZ = np.kron(np.array([[1, 0], [0, 0]]), np.kron(sx, np.kron(sx, np.kron(sy, np.kron(sy, np.kron(sz, sz)))))) + \
-              np.kron(np.array([[0, 0], [0, 1]]), np.kron(s0, np.kron(s0, np.kron(s0, np.kron(s0, np.kron(s0, s0))))))
-
+    # XXYYZZ on locs in order if the ancilla is |0>
     x, y = upper_corner
     if left:
         if x % 2 == 0:
@@ -63,35 +92,97 @@ def apply_cxxyyzz_on_rectangle(tc, upper_corner, left=True):
         else:
             locs = [(x, y), (x + 1, y - 1), (x + 1, y), (x + 2, y), (x + 2, y + 1), (x + 3, y)]
 
-    if not all([is_inside_matching((tc.x, tc.y), l) for l in locs]):
+    if not get_lattice_index(tc.x, tc.y).contains(locs).all():
         return
-    tc.circ.unitary(cXXYYZZ, [tc.regs[l[0]][l[1]] for l in locs[::-1]] + [tc.ancillas[0]])
-
-
-def em_braiding_phase(backend, x, y):
+    tc.circ.append(controlled_pauli_gate('xxyyzz'), [tc.regs[l[0]][l[1]] for l in locs] + [tc.ancillas[0]])
+
+
+# e strings, m strings, controlled loop and its upper corner of every braiding experiment on the 5x7 lattice
+BRAIDING_EXPERIMENTS = {
+    'ee': ([[(2, 1), (2, 2)]], [], apply_cxxxx_on_square, (0, 3)),
+    'em': ([[(2, 1), (2, 2)]], [[(1, 4), (0, 3), (1, 3)]], apply_cxxxx_on_square, (0, 3)),
+    'epsi': ([[(2, 1), (2, 2)], [(1, 4), (3, 4)]], [[(2, 3), (3, 3), (4, 3)]], apply_cxxyyzz_on_rectangle, (0, 3)),
+    'mpsi': ([[(1, 4), (3, 4)]], [[(2, 3), (3, 3), (4, 3)], [(3, 1), (4, 1), (3, 2)]], apply_cxxyyzz_on_rectangle,
+             (0, 3)),
+    'psipsi': ([[(2, 1), (2, 2)], [(1, 4), (3, 4)]], [[(2, 3), (3, 3), (4, 3)], [(3, 1), (4, 1), (3, 2)]],
+               apply_cxxyyzz_on_rectangle, (0, 3)),
+    'psi1': ([[(1, 4), (3, 4)]], [[(2, 3), (3, 3), (4, 3)]], apply_cxxyyzz_on_rectangle, (0, 3)),
+}
+
+
+def braiding_circuit(x, y, experiment, frame=True):
+    """
+    Toric code with the particles of the experiment and an interferometer on the ancilla around the loop.
+    The strings creating the particles are reduced to one Pauli product, see string_operator.
+
+    :param experiment: Key of BRAIDING_EXPERIMENTS, or a tuple (e strings, m strings, loop, upper corner)
+    :param frame: Keep the strings in the Pauli frame of the toric code instead of applying gates
+    :return: ToricCode, the ancilla measured in classical bit 0
+    """
+    e_strings, m_strings, loop, corner = BRAIDING_EXPERIMENTS[experiment] if isinstance(experiment, str) else experiment
     tc = get_toric_code(x, y, classical_bit_count=1, ancillas_count=1)
-
-    x_string = [(2, 1), (2, 2)]
-    create_e_particles(tc, x_string)
-
-    z_string = [(1, 4), (0, 3), (1, 3)]
-    create_m_particles(tc, z_string)
+    apply_string_operator(tc, string_operator(e_strings, m_strings), frame)
 
     tc.circ.h(tc.ancillas[0])
-
-    apply_cxxxx_on_square(tc, (0, 3))
+    loop(tc, corner)
     tc.circ.h(tc.ancillas[0])
 
     tc.circ.measure(tc.ancillas[0], 0)
-    Nshots = 10000
-    job = backend.run(transpile(tc.circ, backend), shots=Nshots)
-    result = job.result()
-    counts = result.get_counts(tc.circ)
-
-    if '0' not in counts:
-        counts['0'] = 0
-    if '1' not in counts:
-        counts['1'] = 0
-
-    cos_theta = (counts['0'] - counts['1']) / Nshots
-    return cos_theta, 0
+    return tc
+
+
+def exact_braiding_phase(tc):
+    """
+    cos(theta) = <Z> of the ancilla, exactly from the stabilizer tableau of the circuit before the measurement.
+    Every braiding loop is a controlled Pauli, so the circuit is Clifford at any lattice size.
+    """
+    circ = tc.circ.remove_final_measurements(inplace=False)
+    z = ['I'] * circ.num_qubits
+    z[circ.find_bit(tc.ancillas[0]).index] = 'Z'
+    sign = -1 if 0 in frame_flips(tc) else 1
+    return sign * float(np.real(StabilizerState(circ).expectation_value(Pauli(''.join(z[::-1])))))
+
+
+def braiding_table(backend, x=5, y=7, experiments=None, target_error=0.01, exact=None, frame=True):
+    """
+    cos(theta) of braiding experiments. Ideal simulators evaluate the ancilla exactly, other backends sample
+    the shots giving a standard error of target_error in the worst case cos(theta) = 0.
+
+    :param experiments: Keys of BRAIDING_EXPERIMENTS, all by default
+    :param exact: Evaluate exactly, defaults to True on simulators without noise model
+    :param frame: Keep the particle strings in the Pauli frame, see braiding_circuit
+    :return: Dictionary {experiment: (cos theta, standard error, (low, high))}, with the bootstrap confidence
+        interval of braiding_phase_interval. Exact values have a zero error and the interval (cos theta, cos theta)
+    """
+    experiments = list(BRAIDING_EXPERIMENTS) if experiments is None else experiments
+    exact = is_ideal_simulator(backend) if exact is None else exact
+    tcs = [braiding_circuit(x, y, experiment, frame) for experiment in experiments]
+    if exact:
+        table = {}
+        for experiment, tc in zip(experiments, tcs):
+            cos_theta = exact_braiding_phase(tc)
+            table[experiment] = cos_theta, 0., (cos_theta, cos_theta)
+        return table
+
+    # shots above the backend limit are split over repeated circuits
+    shots = shots_for_error(target_error)
+    repeats = -(-shots // (max_shots(backend) or shots))
+    circuits = []
+    for tc in tcs:
+        circ = prune_to_light_cone(tc.circ) if is_simulator(backend) else tc.circ
+        circuits += [transpile_on_lattice(circ, backend, tc, tc.circ)] * repeats
+    all_counts = run_batched(backend, circuits, shots=-(-shots // repeats))
+
+    table = {}
+    for i, (experiment, tc) in enumerate(zip(experiments, tcs)):
+        counts = {}
+        for c in all_counts[i * repeats:(i + 1) * repeats]:
+            for outcome, count in c.items():
+                counts[outcome] = counts.get(outcome, 0) + count
+        table[experiment] = braiding_phase_interval(apply_frame(counts, frame_flips(tc)))
+    return table
+
+
+def em_braiding_phase(backend, x, y, target_error=0.01):
+    # (cos theta, standard error, (low, high)) of the e-m braiding experiment
+    return braiding_table(backend, x, y, ['em'], target_error)['em']
@@ -1,12 +1,16 @@
 import itertools
-from collections import defaultdict
 
 import numpy as np
-from qiskit import transpile
-from tqdm import tqdm, trange
-
+from tqdm import tqdm
+
+from counts_table import CountsTable, as_counts_table
+from executor import is_simulator, run_batched
+from lattice_index import get_lattice_index
+from layout import transpile_on_lattice
+from light_cone import prune_to_light_cone
+from result_store import run_stored, setting_key
 from toric_code import get_toric_code
-from toric_code_matching import is_inside_matching, is_corner_matching
+from toric_code_matching import pauli_angles, sample_haar_angles
 
 ABC_DIVISION_2x2 = [(0, 1), (2,), (3,)]
 ABC_DIVISION_2x3_RIGHT = [(1, 3), (0, 2), (4, 5)]
@@ -18,125 +22,298 @@ def hamming_distance(s1, s2):
     return sum(c1 != c2 for c1, c2 in zip(s1, s2))
 
 
+def popcount(arr):
+    arr = np.asarray(arr, dtype=np.uint64)
+    res = np.zeros(arr.shape, dtype=np.int64)
+    while np.any(arr):
+        res += (arr & np.uint64(1)).astype(np.int64)
+        arr = arr >> np.uint64(1)
+    return res
+
+
+def walsh_hadamard(arr):
+    # unnormalized Walsh-Hadamard transform along the last axis, which must have length 2 ** n
+    arr = np.array(arr, dtype=float)
+    lead, size = arr.shape[:-1], arr.shape[-1]
+    h = 1
+    while h < size:
+        arr = arr.reshape(*lead, size // (2 * h), 2, h)
+        a, b = arr[..., 0, :], arr[..., 1, :]
+        arr = np.stack((a + b, a - b), axis=-2)
+        h *= 2
+    return arr.reshape(*lead, size)
+
+
+def _purity_from_transform(c_hat, i_hat, N):
+    q_cnt = c_hat.shape[-1].bit_length() - 1
+    weights = 3. ** popcount(np.arange(2 ** q_cnt))
+    pairs = (weights * c_hat * (c_hat - i_hat)).sum(axis=-1) / 4 ** q_cnt
+    return 2 ** q_cnt * pairs / (N * (N - 1))
+
+
+def purity(histograms):
+    """
+    Batched version of purity_single_realization.
+    The sum of (-2)^(-D(s1, s2)) over all pairs is diagonal in the Walsh-Hadamard basis, with the weight 3^|k| / 4^n.
+
+    :param histograms: Array (realizations, 2 ** q_cnt) of counts indexed by the integer value of the bitstring
+    :return: Array of purities, one per realization
+    """
+    hist = np.asarray(histograms, dtype=float)
+    # the estimator subtracts one for every observed s2, not only for s1 == s2
+    return _purity_from_transform(walsh_hadamard(hist), walsh_hadamard(hist > 0), hist.sum(axis=-1))
+
+
+def _combo_bits(parts):
+    # {tuple of part indices: positions of their bits among the bits of all parts}
+    starts = np.cumsum([0] + [len(part) for part in parts])
+    return {combo: {j for p in combo for j in range(starts[p], starts[p + 1])}
+            for r in range(1, len(parts) + 1) for combo in itertools.combinations(range(len(parts)), r)}
+
+
+def subset_purities(full_counts, parts):
+    """
+    Purities of every union of parts, sharing one transform of the histogram of all parts together.
+    The transform of a marginal is the transform of the joint histogram with zero frequency on the traced out bits.
+
+    :param full_counts: List of dictionaries {s: count} or CountsTable
+    :param parts: List of tuples of bitstring indices, e.g. ABC_DIVISION_2x2
+    :return: Dictionary {tuple of part indices: array of purities per realization}
+    """
+    table = as_counts_table(full_counts)
+    return histogram_subset_purities(table.histograms([i for part in parts for i in part]), parts)
+
+
+def histogram_subset_purities(hist, parts):
+    """
+    subset_purities of dense histograms of the bits of all parts concatenated.
+
+    :param hist: Array (..., realizations, 2 ** bit count), any leading axes, e.g. resamples, are kept
+    :return: Dictionary {tuple of part indices: array (..., realizations) of purities}
+    """
+    hist = np.asarray(hist, dtype=float)
+    lead = hist.shape[:-1]
+    q_cnt = sum(len(part) for part in parts)
+    N = hist.sum(axis=-1)
+    c_hat = walsh_hadamard(hist).reshape(*lead, *[2] * q_cnt)
+    hist = hist.reshape(c_hat.shape)
+
+    res = {}
+    for combo, kept in _combo_bits(parts).items():
+        traced = tuple(len(lead) + j for j in range(q_cnt) if j not in kept)
+        sub_c_hat = c_hat[(Ellipsis,) + tuple(slice(None) if j in kept else 0 for j in range(q_cnt))]
+        sub_hist = hist.sum(axis=traced)
+        res[combo] = _purity_from_transform(sub_c_hat.reshape(*lead, -1),
+                                            walsh_hadamard(sub_hist.reshape(*lead, -1) > 0), N)
+    return res
+
+
+def pauli_subset_purities(full_counts, parts):
+    """
+    Purities of every union of parts from complete Pauli tomography, purity = 2^(-n) sum over Pauli strings of <P>^2.
+    Parity expectations of every setting come from one Walsh-Hadamard transform, <P> is averaged over all settings
+    compatible with P, and the shot noise bias of <P>^2 is removed.
+
+    :param full_counts: Counts of all 3^q_cnt settings, in the order of itertools.product('xyz', repeat=q_cnt),
+        where the setting of qubit j is measured into classical bit j (character q_cnt - 1 - j)
+    :param parts: List of tuples of bitstring indices, e.g. ABC_DIVISION_2x2
+    :return: Dictionary {tuple of part indices: purity}
+    """
+    table = as_counts_table(full_counts)
+    return histogram_pauli_subset_purities(table.histograms([i for part in parts for i in part]), table.q_cnt, parts)
+
+
+def histogram_pauli_subset_purities(hist, q_cnt, parts):
+    """
+    pauli_subset_purities of dense histograms of the bits of all parts concatenated.
+
+    :param hist: Array (..., 3 ** q_cnt, 2 ** bit count), any leading axes, e.g. resamples, are kept
+    :param q_cnt: Number of measured qubits
+    :return: Dictionary {tuple of part indices: array (...) of purities}
+    """
+    hist = np.asarray(hist, dtype=float)
+    assert hist.shape[-2] == 3 ** q_cnt
+    lead = hist.shape[:-2]
+    all_idx = [i for part in parts for i in part]
+    N = hist.sum(axis=-1, keepdims=True)
+    x = walsh_hadamard(hist) / N
+    # sum over settings of x^2 - u, where u = (N x^2 - 1) / (N - 1) is the unbiased estimate of <P>^2
+    bias = (x ** 2 - 1) / (N - 1)
+
+    # axes are labelled ('s', qubit) for settings, ('k', position in all_idx) for bits and ('p', position) for Paulis
+    shape = [*lead] + [3] * q_cnt + [2] * len(all_idx)
+    labels = [('l', j) for j in range(len(lead))] + [('s', j) for j in range(q_cnt)] + \
+             [('k', a) for a in range(len(all_idx))]
+    tensors = [t.reshape(shape) for t in (x, bias, np.ones_like(x))]
+    for a, i in enumerate(all_idx):
+        src = [labels.index(('s', q_cnt - 1 - i)), labels.index(('k', a))]
+        tensors = [np.moveaxis(t, src, [-2, -1]) for t in tensors]
+        labels = [label for j, label in enumerate(labels) if j not in src] + [('p', a)]
+        # Pauli index 0 is the identity, averaged over the setting, 1, 2, 3 are x, y, z
+        tensors = [np.concatenate((t[..., 0].sum(axis=-1, keepdims=True), t[..., 1]), axis=-1) for t in tensors]
+    # qubits outside of the parts are traced out
+    traced = tuple(range(len(lead), len(lead) + q_cnt - len(all_idx)))
+    s1, s2, m = [t.sum(axis=traced) for t in tensors]
+    squares = (s1 ** 2 + s2) / m ** 2
+
+    res = {}
+    for combo, kept in _combo_bits(parts).items():
+        index = (Ellipsis,) + tuple(slice(None) if j in kept else 0 for j in range(len(all_idx)))
+        res[combo] = squares[index].reshape(*lead, -1).sum(axis=-1) / 2 ** len(kept)
+    return res
+
+
+def subset_entropies(full_counts, parts, estimator='randomized'):
+    """
+    Second Renyi entropy of every union of parts, {tuple of part indices: entropy}
+
+    :param estimator: 'randomized' for the shot pair estimator, valid for Haar and Pauli settings,
+        'pauli' for complete Pauli tomography, see pauli_subset_purities
+    """
+    assert estimator in ('randomized', 'pauli')
+    purities = pauli_subset_purities if estimator == 'pauli' else subset_purities
+    return {combo: -np.log(np.mean(pur)) for combo, pur in purities(full_counts, parts).items()}
+
+
 def purity_single_realization(counts):
     # counts is dictionary {s: count}
-    N = sum(counts.values())
-    q_cnt = len(list(counts.keys())[0])
-    pur = 0
-    for s1 in counts:
-        p1 = counts[s1] / N
-        for s2 in counts:
-            factor = (-2) ** (-hamming_distance(s1, s2))
-            p2 = counts[s2] / N
-            pur += 2 ** q_cnt * factor * p1 * (N * p2 - 1) / (N - 1)
-    return pur
+    return purity(CountsTable.from_counts([counts]).histograms())[0]
 
 
 def second_renyi_entropy(all_counts):
-    # all_counts is list of dictionaries {s: count}
-    return -np.log(sum([purity_single_realization(counts) for counts in tqdm(all_counts)]) / len(all_counts))
+    # all_counts is list of dictionaries {s: count} or CountsTable
+    return -np.log(np.mean(purity(as_counts_table(all_counts).histograms())))
 
 
 def get_subsystem_counts(full_counts, sub_idx):
-    all_subsystem_counts = []
-    for counts in full_counts:
-        subsystem_counts = defaultdict(lambda: 0)
-        for s in counts:
-            s_sub = ''.join(s[i] for i in sub_idx)
-            subsystem_counts[s_sub] += counts[s]
-        all_subsystem_counts.append(subsystem_counts)
-    return all_subsystem_counts
+    return as_counts_table(full_counts).marginal(sub_idx)
 
 
 def subsystem_sre(full_counts, sub_idx):
-    return second_renyi_entropy(get_subsystem_counts(full_counts, sub_idx))
+    return -np.log(np.mean(purity(as_counts_table(full_counts).histograms(sub_idx))))
 
 
-def calculate_s_subsystems(full_counts, subsystems):
-    one = [subsystem_sre(full_counts, sub_idx) for sub_idx in subsystems]
-    two_subsystems = [subsystems[0] + subsystems[1], subsystems[0] + subsystems[2], subsystems[1] + subsystems[2]]
-    two = [subsystem_sre(full_counts, sub_idx) for sub_idx in two_subsystems]
-    three = [second_renyi_entropy(full_counts)]
+def calculate_s_subsystems(full_counts, subsystems, estimator='randomized'):
+    s = subset_entropies(full_counts, subsystems, estimator)
+    one = [s[(0,)], s[(1,)], s[(2,)]]
+    two = [s[(0, 1)], s[(0, 2)], s[(1, 2)]]
+    three = [s[(0, 1, 2)]]
     return one, two, three
 
 
-def calculate_s_topo(full_counts, subsystems):
-    one, two, three = calculate_s_subsystems(full_counts, subsystems)
-    print([o / np.log(2) for o in one], [t / np.log(2) for t in two], [t / np.log(2) for t in three])
-    return sum(one) - sum(two) + sum(three)
+def kitaev_preskill_signs(combos):
+    # + single parts, - pairs, + triples
+    return {combo: (-1) ** (len(combo) + 1) for combo in combos}
 
 
-def calculate_topo_entropy_pauli(backend, size, qubits, subsystems):
-    x, y = size
-    all_counts = []
-    all_gates = [''.join(x) for x in itertools.product('xyz', repeat=len(qubits))]
-    for gates in tqdm(all_gates):
-        tc = get_toric_code(x, y, len(qubits))
-        tc.measure_pauli(qubits, gates)
+def kitaev_preskill_sum(entropies):
+    # topological entropy from {tuple of part indices: entropy}, entropies may be arrays of replicas
+    signs = kitaev_preskill_signs(entropies)
+    return sum(signs[combo] * s for combo, s in entropies.items())
+
+
+def calculate_s_topo(full_counts, subsystems, estimator='randomized'):
+    s = subset_entropies(full_counts, subsystems, estimator)
+    print(*[[e / np.log(2) for combo, e in s.items() if len(combo) == r] for r in (1, 2, 3)])
+    return kitaev_preskill_sum(s)
+
+
+def tomography_circuit(backend, tc, light_cone=None):
+    # on simulators only the causal cone of the measured qubits is simulated
+    if light_cone is None:
+        light_cone = is_simulator(backend)
+    # on hardware the lattice is placed by the cached layout, see layout.lattice_layout
+    return transpile_on_lattice(prune_to_light_cone(tc.circ) if light_cone else tc.circ, backend, tc)
 
-        job = backend.run(transpile(tc.circ, backend), shots=1024)
-        result = job.result()
-        counts = result.get_counts(tc.circ)
-        all_counts.append(counts)
-    return calculate_s_topo(all_counts, subsystems)
+
+def pauli_tomography_circuits(backend, size, qubits, light_cone=None, angles=None):
+    # one transpiled circuit per Pauli setting, in the order of itertools.product('xyz', repeat=len(qubits))
+    x, y = size
+    if angles is None:
+        angles = pauli_tomography_angles(len(qubits))
+    tc = get_toric_code(x, y, len(qubits))
+    tc.measure_pauli(qubits)
+    circ = tomography_circuit(backend, tc, light_cone)
+    return [tc.bind_measurement(circ, setting) for setting in tqdm(angles)]
 
 
-def calculate_topo_entropy_haar(backend, size, qubits, subsystems):
+def haar_tomography_circuits(backend, size, qubits, cnt=100, light_cone=None, rng=None, angles=None):
     x, y = size
-    all_counts = []
-    for _ in trange(100):
-        tc = get_toric_code(x, y, len(qubits))
-        tc.measure_haar(qubits)
+    if angles is None:
+        angles = sample_haar_angles((cnt, len(qubits)), rng)
+    tc = get_toric_code(x, y, len(qubits))
+    tc.measure_haar(qubits, parameterized=True)
+    circ = tomography_circuit(backend, tc, light_cone)
+    return [tc.bind_measurement(circ, setting) for setting in tqdm(angles)]
+
+
+def pauli_tomography_angles(q_cnt):
+    return np.array([pauli_angles(gates) for gates in itertools.product('xyz', repeat=q_cnt)])
+
+
+def run_tomography(backend, size, qubits, angles, circuits, shots=1024, store=None):
+    """
+    Counts of every setting, with the angles stored as settings.
+
+    :param circuits: pauli_tomography_circuits or haar_tomography_circuits
+    :param store: Optional ResultStore, settings already in the store are loaded instead of run
+    """
+    def build(settings):
+        return circuits(backend, size, qubits, angles=settings)
+
+    if store is None:
+        return CountsTable.from_counts(run_batched(backend, build(angles), shots=shots), angles)
+    keys = [setting_key(size, qubits, setting, shots, backend) for setting in angles]
+    return run_stored(store, backend, build, keys, angles, shots)
 
-        job = backend.run(transpile(tc.circ, backend), shots=1024)
-        result = job.result()
-        counts = result.get_counts(tc.circ)
-        all_counts.append(counts)
-    return calculate_s_topo(all_counts, subsystems)
+
+def pauli_tomography(backend, size, qubits, shots=1024, store=None):
+    # counts of every Pauli setting, with the measurement angles stored as settings
+    angles = pauli_tomography_angles(len(qubits))
+    return run_tomography(backend, size, qubits, angles, pauli_tomography_circuits, shots, store)
+
+
+def haar_tomography(backend, size, qubits, cnt=100, shots=1024, rng=None, store=None):
+    # counts of cnt Haar random settings, with the sampled angles stored as settings, a seeded rng makes them resumable
+    angles = sample_haar_angles((cnt, len(qubits)), rng)
+    return run_tomography(backend, size, qubits, angles, haar_tomography_circuits, shots, store)
+
+
+def calculate_topo_entropy_pauli(backend, size, qubits, subsystems, store=None):
+    return calculate_s_topo(pauli_tomography(backend, size, qubits, store=store), subsystems, estimator='pauli')
+
+
+def calculate_topo_entropy_haar(backend, size, qubits, subsystems, cnt=100, rng=None, store=None):
+    return calculate_s_topo(haar_tomography(backend, size, qubits, cnt, rng=rng, store=store), subsystems)
+
+
+# qubit offsets of subsystem shapes from their anchor on an even row and on an odd row, see LatticeIndex.placements
+SHAPE_2x2 = (((0, 0), (1, 0), (1, 1), (2, 0)),
+             ((0, 0), (1, -1), (1, 0), (2, 0)))
+SHAPE_2x3_LEFT = (((0, 0), (1, 0), (1, 1), (2, 0), (2, 1), (3, 1)),
+                  ((0, 0), (1, -1), (1, 0), (2, 0), (2, 1), (3, 0)))
+SHAPE_2x3_RIGHT = (((0, 0), (1, 0), (1, 1), (2, -1), (2, 0), (3, 0)),
+                   ((0, 0), (1, -1), (1, 0), (2, -1), (2, 0), (3, -1)))
+SHAPE_3x3 = (None,
+             ((0, 0), (1, -1), (1, 0), (2, -1), (2, 0), (2, 1), (3, -1), (3, 0), (4, 0)))
+
+
+def get_all_non_corner(size, shape):
+    # every placement of shape not touching a corner, as tuples of coordinates
+    placements = get_lattice_index(*size).placements(shape)
+    return [tuple(zip(rows, cols)) for rows, cols in zip(placements[..., 0].tolist(), placements[..., 1].tolist())]
 
 
 def get_all_2x2_non_corner(size):
-    x, y = size
-    all_sys = []
-    for rx in range(x):
-        for ry in range(y):
-            if rx % 2 == 0:
-                sys = (rx, ry), (rx + 1, ry), (rx + 1, ry + 1), (rx + 2, ry)
-            else:
-                sys = (rx, ry), (rx + 1, ry - 1), (rx + 1, ry), (rx + 2, ry)
-            if all([is_inside_matching(size, s) for s in sys]) and not any([is_corner_matching(size, s) for s in sys]):
-                all_sys.append(sys)
-    return all_sys
+    return get_all_non_corner(size, SHAPE_2x2)
 
 
 def get_all_2x3_left_non_corner(size):
-    x, y = size
-    all_sys = []
-    for rx in range(x):
-        for ry in range(y):
-            if rx % 2 == 0:
-                sys_l = (rx, ry), (rx + 1, ry), (rx + 1, ry + 1), (rx + 2, ry), (rx + 2, ry + 1), (rx + 3, ry + 1)
-            else:
-                sys_l = (rx, ry), (rx + 1, ry - 1), (rx + 1, ry), (rx + 2, ry), (rx + 2, ry + 1), (rx + 3, ry)
-            if all([is_inside_matching(size, s) for s in sys_l]) and not any(
-                    [is_corner_matching(size, s) for s in sys_l]):
-                all_sys.append(sys_l)
-    return all_sys
+    return get_all_non_corner(size, SHAPE_2x3_LEFT)
 
 
 def get_all_2x3_right_non_corner(size):
-    x, y = size
-    all_sys = []
-    for rx in range(x):
-        for ry in range(y):
-            if rx % 2 == 0:
-                sys_r = (rx, ry), (rx + 1, ry), (rx + 1, ry + 1), (rx + 2, ry - 1), (rx + 2, ry), (rx + 3, ry)
-            else:
-                sys_r = (rx, ry), (rx + 1, ry - 1), (rx + 1, ry), (rx + 2, ry - 1), (rx + 2, ry), (rx + 3, ry - 1)
-            if all([is_inside_matching(size, s) for s in sys_r]) and not any(
-                    [is_corner_matching(size, s) for s in sys_r]):
-                all_sys.append(sys_r)
-    return all_sys
+    return get_all_non_corner(size, SHAPE_2x3_RIGHT)
 
 
 def get_all_2x3_non_corner(size):
@@ -144,14 +321,4 @@ def get_all_2x3_non_corner(size):
 
 
 def get_all_3x3_non_corner(size):
-    x, y = size
-    all_sys = []
-    for rx in range(x):
-        for ry in range(y):
-            if rx % 2 == 0:
-                sys = [(-1, -1)]  # skip, why
-            else:
-                sys = (rx, ry), (rx + 1, ry - 1), (rx + 1, ry), (rx + 2, ry - 1), (rx + 2, ry), (rx + 2, ry + 1), (rx + 3, ry - 1), (rx + 3, ry), (rx + 4, ry),
-            if all([is_inside_matching(size, s) for s in sys]) and not any([is_corner_matching(size, s) for s in sys]):
-                all_sys.append(sys)
-    return all_sys
+    return get_all_non_corner(size, SHAPE_3x3)
@@ -0,0 +1,77 @@
+import itertools
+from functools import lru_cache
+
+import numpy as np
+from qiskit.quantum_info import Clifford
+
+from lattice_index import get_lattice_index
+from topo_entropy import kitaev_preskill_sum
+from toric_code import get_toric_code
+
+
+def gf2_rank(mat):
+    mat = np.array(mat, dtype=bool)
+    rank = 0
+    for col in range(mat.shape[1]):
+        pivots = np.flatnonzero(mat[rank:, col])
+        if len(pivots) == 0:
+            continue
+        pivot = rank + pivots[0]
+        mat[[rank, pivot]] = mat[[pivot, rank]]
+        lower = rank + 1 + np.flatnonzero(mat[rank + 1:, col])
+        mat[lower] ^= mat[rank]
+        rank += 1
+        if rank == mat.shape[0]:
+            break
+    return rank
+
+
+@lru_cache(maxsize=None)
+def ground_state_stabilizers(x, y):
+    """
+    Stabilizer generators of the toric code ground state, built from the Clifford preparation circuit.
+
+    :return: (X part, Z part), boolean arrays (generators, qubits), the columns in the order of LatticeIndex.coords
+    """
+    cliff = Clifford(get_toric_code(x, y).ground_state)
+    return cliff.stab_x, cliff.stab_z
+
+
+def stabilizer_entropy(size, qubits):
+    """
+    Entropy of the reduced ground state on qubits, S = rank(generators restricted to qubits) - |qubits|.
+    Reduced stabilizer states are flat, so every Renyi entropy equals this value.
+
+    :param size: Lattice size (x, y)
+    :param qubits: Lattice coordinates of the subsystem
+    :return: Entropy in nats, the unit of second_renyi_entropy
+    """
+    stab_x, stab_z = ground_state_stabilizers(*size)
+    index = get_lattice_index(*size)
+    assert index.contains(qubits).all(), f'qubits off the {size} lattice'
+    cols = index.flat_index(qubits)
+    restricted = np.concatenate((stab_x[:, cols], stab_z[:, cols]), axis=1)
+    return (gf2_rank(restricted) - len(cols)) * np.log(2)
+
+
+def stabilizer_subset_entropies(size, qubits, parts):
+    # same as topo_entropy.subset_entropies, parts index the measured bitstring, whose character i is qubits[-1 - i]
+    res = {}
+    for r in range(1, len(parts) + 1):
+        for combo in itertools.combinations(range(len(parts)), r):
+            res[combo] = stabilizer_entropy(size, [qubits[len(qubits) - 1 - i] for p in combo for i in parts[p]])
+    return res
+
+
+def stabilizer_s_subsystems(size, qubits, subsystems):
+    s = stabilizer_subset_entropies(size, qubits, subsystems)
+    return [s[(0,)], s[(1,)], s[(2,)]], [s[(0, 1)], s[(0, 2)], s[(1, 2)]], [s[(0, 1, 2)]]
+
+
+def stabilizer_topo_entropy(size, qubits, subsystems):
+    return kitaev_preskill_sum(stabilizer_subset_entropies(size, qubits, subsystems))
+
+
+def topo_entropy_map(size, placements, subsystems):
+    # {placement: topological entropy} for placements from get_all_*_non_corner
+    return {tuple(qubits): stabilizer_topo_entropy(size, qubits, subsystems) for qubits in placements}
@@ -2,9 +2,20 @@ from toric_code_matching import ToricCodeMatching
 from toric_code_mixed import ToricCodeMixed
 
 
-def get_toric_code(x, y, classical_bit_count=4, ancillas_count=0, boundary_condition='matching'):
+def get_toric_code(x, y, classical_bit_count=4, ancillas_count=0, boundary_condition='matching', schedule='layered',
+                   preparation='unitary'):
     assert boundary_condition in ('mixed', 'matching')
     if boundary_condition == 'matching':
-        return ToricCodeMatching(x, y, classical_bit_count, ancillas_count)
+        return ToricCodeMatching(x, y, classical_bit_count, ancillas_count, schedule, preparation)
     elif boundary_condition == 'mixed':
         return ToricCodeMixed(x, y, classical_bit_count, ancillas_count)
+
+
+def ground_state_report(sizes, schedules=('sequential', 'layered', 'fanout')):
+    # depth and CNOT count of the ground state preparation, [(size, schedule, depth, cx count)]
+    report = []
+    for x, y in sizes:
+        for schedule in schedules:
+            circ = get_toric_code(x, y, schedule=schedule).ground_state
+            report.append(((x, y), schedule, circ.depth(), circ.count_ops().get('cx', 0)))
+    return report
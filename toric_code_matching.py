@@ -1,6 +1,12 @@
+import functools
+import itertools
+
 import numpy as np
 from qiskit import QuantumRegister, QuantumCircuit, ClassicalRegister
-from scipy.stats import rv_continuous
+from qiskit.circuit import ParameterVector
+from qiskit.circuit.classical import expr
+
+from lattice_index import PLAQUETTE_OFFSETS, get_lattice_index
 
 
 def first_step_matching(repr_x, repr_y):
@@ -19,9 +25,52 @@ def third_step_right_matching(repr_x, repr_y):
     return (repr_x + 1, repr_y + 1), (repr_x + 2, repr_y)
 
 
+def correction_string_matching(repr_x, repr_y, x):
+    """
+    Z string below the representative anticommuting with this plaquette only, it runs along the middle row of the
+    plaquette to the nearer boundary, so every other plaquette of the row contains zero or two of its qubits.
+
+    :param x: Column count of the lattice
+    """
+    if repr_y + 1 <= x - 1 - repr_y:
+        return [(repr_x + 1, j) for j in range(repr_y + 1)]
+    return [(repr_x + 1, j) for j in range(repr_y + 1, x)]
+
+
+def cnot_commutes(a, b):
+    # CNOTs commute unless the control of one is the target of the other
+    return a[0] != b[1] and a[1] != b[0]
+
+
+def cnot_layers(cnots):
+    """
+    Packs CNOTs into layers of gates on disjoint qubits, every gate as early as possible.
+    A gate may move before earlier gates it commutes with, e.g. CNOTs sharing only their control or only their target,
+    so the product of the layers equals the product of cnots.
+
+    :param cnots: List of (control, target) in circuit order
+    :return: List of layers, every layer a list of (control, target)
+    """
+    layers, busy = [], []
+    placed = {}  # qubit: [(layer index, cnot)] of the gates acting on it
+    for cnot in cnots:
+        layer = 1 + max([i for q in cnot for i, other in placed.get(q, []) if not cnot_commutes(cnot, other)],
+                        default=-1)
+        while layer < len(layers) and not busy[layer].isdisjoint(cnot):
+            layer += 1
+        if layer == len(layers):
+            layers.append([])
+            busy.append(set())
+        layers[layer].append(cnot)
+        busy[layer].update(cnot)
+        for q in cnot:
+            placed.setdefault(q, []).append((layer, cnot))
+    return layers
+
+
 def get_plaquette_matching(x, y):
     repr_x, repr_y = x * 2, y
-    return (repr_x, repr_y), (repr_x + 1, repr_y), (repr_x + 1, repr_y + 1), (repr_x + 2, repr_y)
+    return tuple((repr_x + dx, repr_y + dy) for dx, dy in PLAQUETTE_OFFSETS)
 
 
 def get_star_matching(x, y, size_x, size_y):
@@ -42,66 +91,158 @@ def get_star_matching(x, y, size_x, size_y):
     return res
 
 
-class sin_prob_dist(rv_continuous):
-    def _pdf(self, theta):
-        # The 0.5 is so that the distribution is normalized
-        return 0.5 * np.sin(theta)
+def get_star_qubits_matching(x, y, size):
+    """
+    Qubits of the Z star of the vertex in vertex row x (lattice row 2x) and column y.
+    Stars on the boundary have 3 qubits, 2 in the corners, and are stabilizers as well.
+
+    :param size: Lattice size (x, y)
+    """
+    lattice = get_lattice_index(*size)
+    return tuple(tuple(map(int, lattice.coords[i])) for i in lattice.stars[x, y] if i >= 0)
+
+
+# u(theta, phi, lambda) angles rotating the given Pauli eigenbasis onto the computational basis
+PAULI_ANGLES = {'x': (np.pi / 2, 0., np.pi), 'y': (np.pi / 2, 0., np.pi / 2), 'z': (0., 0., 0.)}
+
+
+def pauli_angles(gates):
+    return np.array([PAULI_ANGLES[gate] for gate in gates])
+
+
+def sample_haar_angles(shape, rng=None):
+    """
+    Angles of u(theta, phi, lambda) for Haar random single qubit rotations,
+    see https://pennylane.ai/qml/demos/tutorial_haar_measure.html
+
+    :param shape: Number of qubits, or e.g. (realizations, qubits)
+    :param rng: numpy Generator or seed, see spawn_generators for independent streams of parallel workers
+    :return: Array (*shape, 3)
+    """
+    rng = np.random.default_rng(rng)
+    shape = np.atleast_1d(shape)
+    # theta has density sin(theta) / 2 on [0, pi], with inverse CDF arccos(1 - 2u)
+    theta = np.arccos(1 - 2 * rng.uniform(size=shape))
+    phi, lam = 2 * np.pi * rng.uniform(size=(2, *shape))
+    return np.stack((theta, phi, lam), axis=-1)
+
+
+def spawn_generators(seed, count):
+    # independent and reproducible random streams, one per worker
+    return [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(count)]
 
 
 def is_inside_matching(size, coo):
-    x, y = size
-    j, i = coo
-    if j < 0 or j >= y:
-        return False
-    if j % 2 == 0:
-        return i < x - 1
-    return i < x
+    return bool(get_lattice_index(*size).contains(coo))
 
 
 def is_corner_matching(size, coo):
-    x, y = size
-    j, i = coo
-    if j == 0 or j == y - 1:
-        if i == 0 or i == x - 2:
-            return True
-    if j == 1 or j == y - 2:
-        if i == 0 or i == x - 1:
-            return True
-    return False
+    return bool(get_lattice_index(*size).is_corner(coo))
 
 
 class ToricCodeMatching:
-    def __init__(self, x, y, classical_bit_count=4, ancillas_count=0):
+    # ground state preparation circuits shared by all instances, keyed by (x, y, ancillas_count, schedule, preparation)
+    _ground_states = {}
+    _circuit_ids = itertools.count()
+
+    def __init__(self, x, y, classical_bit_count=4, ancillas_count=0, schedule='layered', preparation='unitary'):
         """
 
         :param x: Column count. In case of matching boundary condition even rows has one less qubit
         :param y: Row count
         :param classical_bit_count: Number of classical bits
+        :param schedule: Order of the ground state CNOTs, 'sequential' column pair by column pair as in the paper,
+            'layered' the same CNOTs packed by cnot_layers, 'fanout' see fanout_cnots
+        :param preparation: 'unitary' for the CNOT circuit of schedule, 'measured' for the constant depth preparation
+            of init_measured. Its syndrome is a classical register of its own, see register_counts
         """
         self.x, self.y = x, y
         self.plaquette_x, self.plaquette_y = self.x - 1, self.y // 2
         self.star_x, self.star_y = self.x, self.y // 2 + 1
         # print(self.plaquette_x, self.plaquette_y)
-        self.regs = [QuantumRegister(self.x - 1, f'l{lev}') if lev % 2 == 0 else QuantumRegister(self.x, f'l{lev}')
-                     for lev in range(self.y)]  # first coordinate is row index, second is column index
+
+        plaquette_reprs_all = []
+        for i in range(self.y):
+            if i % 2 == 0 and i != self.y - 1:
+                for j in range(self.x - 1):
+                    plaquette_reprs_all.append((i, j))
+        self.plaquette_reprs_all = plaquette_reprs_all
+        self.plaquette_reprs_cols = [[rep for rep in plaquette_reprs_all if rep[1] == i] for i in range(self.x - 1)]
+
+        assert schedule in ('sequential', 'layered', 'fanout')
+        assert preparation in ('unitary', 'measured')
+        key = (x, y, ancillas_count, schedule, preparation)
+        if key not in self._ground_states:
+            self._ground_states[key] = self.build_ground_state(ancillas_count, schedule, preparation)
+        # the cached circuit is never modified, every instance appends to its own copy
+        self.ground_state = self._ground_states[key]
+        self.regs = self.ground_state.qregs[:self.y]  # first coordinate is row index, second is column index
+        if ancillas_count > 0:
+            self.ancillas = self.ground_state.qregs[self.y]
         self.c_reg = ClassicalRegister(classical_bit_count)
+        self.circ = self.ground_state.copy(name=f'toric_code_{next(self._circuit_ids)}')
+        self.circ.add_register(self.c_reg)
+        # Pauli products kept classically, as (position in circ.data, paulis), see anyon_paths.apply_string_operator
+        self.frame = []
+
+    def build_ground_state(self, ancillas_count=0, schedule='layered', preparation='unitary'):
+        self.regs = [QuantumRegister(self.x - 1, f'l{lev}') if lev % 2 == 0 else QuantumRegister(self.x, f'l{lev}')
+                     for lev in range(self.y)]
         if ancillas_count > 0:
             self.ancillas = QuantumRegister(ancillas_count)
-            self.circ = QuantumCircuit(*self.regs, self.ancillas, self.c_reg)
+            self.circ = QuantumCircuit(*self.regs, self.ancillas)
         else:
-            self.circ = QuantumCircuit(*self.regs, self.c_reg)
+            self.circ = QuantumCircuit(*self.regs)
 
-        plaquette_reprs_all = []
-        for i, r in enumerate(self.regs):
-            if i % 2 == 0 and i != self.y - 1:
-                self.circ.h(r)
-                for j in range(r.size):
-                    plaquette_reprs_all.append((i, j))
+        if preparation == 'measured':
+            self.init_measured()
+            return self.circ
+        for i, j in self.plaquette_reprs_all:
+            self.circ.h(self.regs[i][j])
+        self.init_matching(schedule)
+        return self.circ
 
-        self.plaquette_reprs_cols = [[rep for rep in plaquette_reprs_all if rep[1] == i] for i in range(self.x - 1)]
-        self.init_matching()
+    def init_measured(self):
+        """
+        Constant depth preparation. |0...0> satisfies every star, measuring every plaquette with its own ancilla
+        in 4 CNOT layers projects onto the ground state up to Z strings, which are corrected by feed-forward.
+        Every qubit gets at most one Z, conditioned on the parity of the syndrome bits of the strings through it.
+        """
+        syndrome_ancillas = QuantumRegister(len(self.plaquette_reprs_all), 'syndrome_ancillas')
+        syndrome = ClassicalRegister(len(self.plaquette_reprs_all), 'syndrome')
+        self.circ.add_register(syndrome_ancillas, syndrome)
+
+        plaquettes = [get_plaquette_matching(i // 2, j) for i, j in self.plaquette_reprs_all]
+        self.circ.h(syndrome_ancillas)
+        # plaquettes of a row share qubits, which are at different positions of the plaquettes
+        for step in range(4):
+            for anc, qubits in zip(syndrome_ancillas, plaquettes):
+                q = qubits[step]
+                self.circ.cnot(anc, self.regs[q[0]][q[1]])
+        self.circ.h(syndrome_ancillas)
+        self.circ.measure(syndrome_ancillas, syndrome)
+
+        corrections = {}
+        for bit, rep in zip(syndrome, self.plaquette_reprs_all):
+            for q in correction_string_matching(*rep, self.x):
+                corrections.setdefault(q, []).append(bit)
+        for (i, j), bits in sorted(corrections.items()):
+            with self.circ.if_test(functools.reduce(expr.bit_xor, bits[1:], expr.lift(bits[0]))):
+                self.circ.z(self.regs[i][j])
+
+    def init_matching(self, schedule='layered'):
+        if schedule == 'sequential':
+            cnots = self.matching_cnots()
+        elif schedule == 'layered':
+            cnots = [cnot for layer in cnot_layers(self.matching_cnots()) for cnot in layer]
+        else:
+            cnots = [cnot for layer in cnot_layers(self.fanout_cnots()) for cnot in layer]
+        for from_q, to_q in cnots:
+            self.circ.cnot(self.regs[from_q[0]][from_q[1]], self.regs[to_q[0]][to_q[1]])
 
-    def init_matching(self):
+    def matching_cnots(self):
+        # (control, target) of the ground state preparation, spreading out from the middle column pair
+        cnots = []
         order = []
         for i in range((self.x - 1) // 2):
             order.append((i, self.x - 1 - (i + 1)))
@@ -109,50 +250,52 @@ class ToricCodeMatching:
 
         for col in order[0]:
             for rep in self.plaquette_reprs_cols[col]:
-                from_q, to_q = first_step_matching(*rep)
-
-                # print(from_q, to_q)
-                self.circ.cnot(self.regs[from_q[0]][from_q[1]], self.regs[to_q[0]][to_q[1]])
+                cnots.append(first_step_matching(*rep))
 
         for col in order[0]:
             for rep in self.plaquette_reprs_cols[col]:
-                from_q, to_q = second_step_matching(*rep)
-                self.circ.cnot(self.regs[from_q[0]][from_q[1]], self.regs[to_q[0]][to_q[1]])
+                cnots.append(second_step_matching(*rep))
 
         for i, col_pair in enumerate(order[1:]):
 
             for rep in self.plaquette_reprs_cols[order[i][0]]:
-                from_q, to_q = third_step_left_matching(*rep)
-                self.circ.cnot(self.regs[from_q[0]][from_q[1]], self.regs[to_q[0]][to_q[1]])
+                cnots.append(third_step_left_matching(*rep))
             for rep in self.plaquette_reprs_cols[order[i][1]]:
-                from_q, to_q = third_step_right_matching(*rep)
-                self.circ.cnot(self.regs[from_q[0]][from_q[1]], self.regs[to_q[0]][to_q[1]])
+                cnots.append(third_step_right_matching(*rep))
 
             for col in col_pair:
                 for rep in self.plaquette_reprs_cols[col]:
-                    from_q, to_q = first_step_matching(*rep)
-
-                    # print(from_q, to_q)
-                    self.circ.cnot(self.regs[from_q[0]][from_q[1]], self.regs[to_q[0]][to_q[1]])
+                    cnots.append(first_step_matching(*rep))
 
             for col in col_pair:
                 for rep in self.plaquette_reprs_cols[col]:
-                    from_q, to_q = second_step_matching(*rep)
-                    self.circ.cnot(self.regs[from_q[0]][from_q[1]], self.regs[to_q[0]][to_q[1]])
+                    cnots.append(second_step_matching(*rep))
 
         for rep in self.plaquette_reprs_cols[order[-1][0]]:
-            from_q, to_q = third_step_left_matching(*rep)
-            self.circ.cnot(self.regs[from_q[0]][from_q[1]], self.regs[to_q[0]][to_q[1]])
+            cnots.append(third_step_left_matching(*rep))
         for rep in self.plaquette_reprs_cols[order[-1][1]]:
-            from_q, to_q = third_step_right_matching(*rep)
-            self.circ.cnot(self.regs[from_q[0]][from_q[1]], self.regs[to_q[0]][to_q[1]])
+            cnots.append(third_step_right_matching(*rep))
+        return cnots
+
+    def fanout_cnots(self):
+        """
+        Every plaquette representative spreads X to the other three plaquette qubits directly, without the relay of
+        third_step_*_matching, so the vertical CNOTs skip the middle row and are not nearest neighbour on the lattice.
+        Lower plaquette rows go first, a representative is a target of the plaquette above only after its own fan-out.
+        """
+        cnots = []
+        for rep in sorted(self.plaquette_reprs_all, key=lambda rep: -rep[0]):
+            for step in (first_step_matching, second_step_matching):
+                cnots.append(step(*rep))
+            cnots.append((rep, (rep[0] + 2, rep[1])))
+        return cnots
 
     def measure_plaquette(self, x, y):
         qubits = get_plaquette_matching(x, y)
         self.circ.barrier()
         # measure in x basis
         self.circ.h([self.regs[q[0]][q[1]] for q in qubits])
-        self.circ.measure([self.regs[q[0]][q[1]] for q in qubits], range(4))
+        self.circ.measure([self.regs[q[0]][q[1]] for q in qubits], self.c_reg[:4])
         # print(self.circ)
 
     def measure_star(self, x, y):
@@ -160,22 +303,35 @@ class ToricCodeMatching:
         if len(qubits) < 4:
             return
         self.circ.barrier()
-        self.circ.measure([self.regs[q[0]][q[1]] for q in qubits], range(4))
+        self.circ.measure([self.regs[q[0]][q[1]] for q in qubits], self.c_reg[:4])
         # print(self.circ)
 
-    def measure_haar(self, qubits):
+    def measure_lattice(self, basis='z'):
+        # every lattice qubit in the x or z basis, the j-th qubit of the rows in classical bit j
+        qubits = [q for reg in self.regs for q in reg]
         self.circ.barrier()
-        for x, y in qubits:
-            # https://pennylane.ai/qml/demos/tutorial_haar_measure.html
-            # Samples of theta should be drawn from between 0 and pi
-            sin_sampler = sin_prob_dist(a=0, b=np.pi)
+        if basis == 'x':
+            self.circ.h(qubits)
+        self.circ.measure(qubits, self.c_reg[:len(qubits)])
 
-            phi, lam = 2 * np.pi * np.random.uniform(size=2)  # Sample phi and omega as normal
-            theta = sin_sampler.rvs(size=1)[0]  # Sample theta from our new distribution
+    def measure_haar(self, qubits, parameterized=False, rng=None):
+        if parameterized:
+            self.measure_parameterized(qubits)
+            return
+        self.circ.barrier()
+        for (x, y), (theta, phi, lam) in zip(qubits, sample_haar_angles(len(qubits), rng)):
             self.circ.u(theta, phi, lam, self.regs[x][y])
-        self.circ.measure([self.regs[q[0]][q[1]] for q in qubits], range(len(qubits)))
+        self.circ.measure([self.regs[q[0]][q[1]] for q in qubits], self.c_reg[:len(qubits)])
 
-    def measure_pauli(self, qubits, gates):
+    def measure_pauli(self, qubits, gates=None):
+        """
+
+        :param qubits: Measured qubits
+        :param gates: Measurement basis of every qubit, e.g. 'xyz'. If None, the basis is left as a parameter
+        """
+        if gates is None:
+            self.measure_parameterized(qubits)
+            return
         self.circ.barrier()
         for (x, y), gate in zip(qubits, gates):
             if gate == 'x':
@@ -185,4 +341,20 @@ class ToricCodeMatching:
                 self.circ.h(self.regs[x][y])
             if gate == 'z':
                 pass
-        self.circ.measure([self.regs[q[0]][q[1]] for q in qubits], range(len(qubits)))
+        self.circ.measure([self.regs[q[0]][q[1]] for q in qubits], self.c_reg[:len(qubits)])
+
+    def measure_parameterized(self, qubits):
+        # one u(theta, phi, lambda) per qubit, so the circuit can be transpiled once and bound per setting
+        self.measure_params = ParameterVector('m', 3 * len(qubits))
+        self.circ.barrier()
+        for i, (x, y) in enumerate(qubits):
+            self.circ.u(*self.measure_params[3 * i:3 * i + 3], self.regs[x][y])
+        self.circ.measure([self.regs[q[0]][q[1]] for q in qubits], self.c_reg[:len(qubits)])
+
+    def bind_measurement(self, circ, angles):
+        """
+
+        :param circ: Circuit containing measure_params, e.g. transpiled self.circ
+        :param angles: Array (len(qubits), 3) of u angles, see pauli_angles and sample_haar_angles
+        """
+        return circ.assign_parameters({self.measure_params: np.ravel(angles)})
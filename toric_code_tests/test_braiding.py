@@ -1,10 +1,16 @@
+import functools
 import unittest
 
 import numpy as np
 from qiskit import Aer
-from qiskit import transpile
+from qiskit import QuantumCircuit, transpile
+from qiskit.quantum_info import Operator
 
+from anyon_paths import apply_frame, string_operator
+from error_bars import braiding_phase_interval
+from light_cone import prune_to_light_cone
 from topo_braiding import create_e_particles, create_m_particles, apply_cxxxx_on_square, apply_cxxyyzz_on_rectangle
+from topo_braiding import braiding_table, controlled_pauli_gate
 from toric_code import get_toric_code
 
 
@@ -27,7 +33,7 @@ class TestBraiding(unittest.TestCase):
 
             tc.circ.measure(tc.ancillas[0], 0)
             Nshots = 10000
-            job = backend.run(transpile(tc.circ, backend), shots=Nshots)
+            job = backend.run(transpile(prune_to_light_cone(tc.circ), backend), shots=Nshots)
             result = job.result()
             counts = result.get_counts(tc.circ)
 
@@ -43,7 +49,8 @@ class TestBraiding(unittest.TestCase):
 
     def test_psipsi_exchange(self):
         x, y = 5, 7
-        backend = Aer.get_backend('aer_simulator')
+        # the circuit is Clifford, Aer 0.13 stabilizer simulation gets some Clifford circuits wrong
+        backend = Aer.get_backend('aer_simulator_statevector')
         sq = (0, 3)
         tc = get_toric_code(x, y, classical_bit_count=1, ancillas_count=1)
 
@@ -63,7 +70,7 @@ class TestBraiding(unittest.TestCase):
 
         tc.circ.measure(tc.ancillas[0], 0)
         Nshots = 10000
-        job = backend.run(transpile(tc.circ, backend), shots=Nshots)
+        job = backend.run(transpile(prune_to_light_cone(tc.circ), backend), shots=Nshots)
         result = job.result()
         counts = result.get_counts(tc.circ)
 
@@ -79,7 +86,8 @@ class TestBraiding(unittest.TestCase):
 
     def test_psione_braiding(self):
         x, y = 5, 7
-        backend = Aer.get_backend('aer_simulator')
+        # the circuit is Clifford, Aer 0.13 stabilizer simulation gets some Clifford circuits wrong
+        backend = Aer.get_backend('aer_simulator_statevector')
         sq = (0, 3)
         tc = get_toric_code(x, y, classical_bit_count=1, ancillas_count=1)
 
@@ -97,7 +105,7 @@ class TestBraiding(unittest.TestCase):
 
         tc.circ.measure(tc.ancillas[0], 0)
         Nshots = 10000
-        job = backend.run(transpile(tc.circ, backend), shots=Nshots)
+        job = backend.run(transpile(prune_to_light_cone(tc.circ), backend), shots=Nshots)
         result = job.result()
         counts = result.get_counts(tc.circ)
 
@@ -126,7 +134,7 @@ class TestBraiding(unittest.TestCase):
 
             tc.circ.measure(tc.ancillas[0], 0)
             Nshots = 10000
-            job = backend.run(transpile(tc.circ, backend), shots=Nshots)
+            job = backend.run(transpile(prune_to_light_cone(tc.circ), backend), shots=Nshots)
             result = job.result()
             counts = result.get_counts(tc.circ)
 
@@ -141,5 +149,63 @@ class TestBraiding(unittest.TestCase):
             np.testing.assert_allclose(cos_theta, expected_res)
 
 
+class TestControlledPauli(unittest.TestCase):
+    def test_dense_equivalence(self):
+        # the gates equal the dense unitaries they replaced, which had the ancilla |0> projector as leftmost factor
+        sz = np.array([[1, 0], [0, -1]])
+        sx = np.array([[0, 1], [1, 0]])
+        sy = np.array([[0, 1.0j], [-1.0j, 0]])
+        p0, p1 = np.diag([1, 0]), np.diag([0, 1])
+        for paulis, factors, dense_qubits in [('zzzz', [sz] * 4, [0, 1, 2, 3, 4]),
+                                              ('xxyyzz', [sx, sx, sy, sy, sz, sz], [5, 4, 3, 2, 1, 0, 6])]:
+            dense = np.kron(p0, functools.reduce(np.kron, factors)) + np.kron(p1, np.eye(2 ** len(factors)))
+            dense_circ = QuantumCircuit(len(paulis) + 1)
+            dense_circ.unitary(dense, dense_qubits)
+            circ = QuantumCircuit(len(paulis) + 1)
+            circ.append(controlled_pauli_gate(paulis), range(len(paulis) + 1))
+            self.assertEqual(Operator(dense_circ), Operator(circ))
+            self.assertTrue(set(transpile(circ, basis_gates=['cx', 'cz', 's', 'sdg', 'x', 'z']).count_ops()) <=
+                            {'cx', 'cz', 's', 'sdg', 'x', 'z'})
+
+
+class TestBraidingTable(unittest.TestCase):
+    expected = {'ee': 1., 'em': -1., 'epsi': -1., 'mpsi': 1., 'psipsi': -1., 'psi1': 1.}
+
+    def test_exact(self):
+        for frame in (True, False):
+            table = braiding_table(Aer.get_backend('aer_simulator'), frame=frame)
+            self.assertEqual({experiment: cos_theta for experiment, (cos_theta, _, _) in table.items()}, self.expected)
+            self.assertTrue(all(err == 0. and low == high == cos_theta
+                                for cos_theta, err, (low, high) in table.values()))
+
+    def test_sampled(self):
+        # the phases are deterministic, so every shot of the sampled fallback agrees with the exact value
+        backend = Aer.get_backend('aer_simulator_statevector')
+        table = braiding_table(backend, target_error=0.05, exact=False)
+        self.assertEqual({experiment: cos_theta for experiment, (cos_theta, _, _) in table.items()}, self.expected)
+        self.assertTrue(all(low <= cos_theta <= high for cos_theta, _, (low, high) in table.values()))
+
+    def test_phase_interval(self):
+        # cos theta = p0 - p1, empty counts and a single resample have no interval
+        cos_theta, err, (low, high) = braiding_phase_interval({'0': 30, '1': 10}, rng=0)
+        self.assertEqual(cos_theta, 0.5)
+        self.assertTrue(0 < err and low <= cos_theta <= high)
+        for counts, resamples in (({}, 1000), ({'0': 0, '1': 0}, 1000), ({'0': 30, '1': 10}, 1)):
+            with self.assertRaises(ValueError):
+                braiding_phase_interval(counts, resamples)
+
+
+class TestAnyonPaths(unittest.TestCase):
+    def test_string_operator(self):
+        # a qubit crossed twice by e paths cancels, a qubit on both an e and an m path gets Y
+        paulis = string_operator([[(0, 1), (1, 1)], [(1, 1), (2, 1)], [(2, 2)]], [[(2, 2), (3, 2)]])
+        self.assertEqual(paulis, {(0, 1): 'x', (2, 1): 'x', (2, 2): 'y', (3, 2): 'z'})
+
+    def test_apply_frame(self):
+        counts = {'01 10': 3, '00 11': 5}
+        self.assertEqual(apply_frame(counts, [0, 3]), {'11 11': 3, '10 10': 5})
+        self.assertIs(apply_frame(counts, []), counts)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,5 @@
 import itertools
+import tempfile
 import unittest
 
 import numpy as np
@@ -6,35 +7,42 @@ from qiskit import Aer
 from qiskit import transpile
 from tqdm import tqdm
 
+from adaptive_sampling import StreamingTopoEntropy, calculate_topo_entropy_haar_adaptive
+from counts_table import CountsTable
+from error_bars import bootstrap_subset_entropies, entropy_intervals, jackknife_topo_entropy
+from executor import run_batched
+from lattice_dataset import dataset_counts, dataset_topo_entropy_map, lattice_qubits
+from lattice_index import get_lattice_index
+from light_cone import prune_to_light_cone
+from parallel_sweep import parallel_topo_entropy_map
+from placement_groups import group_placements, grouped_pauli_tomography
+from result_store import ResultStore
 from topo_entropy import ABC_DIVISION_2x2, ABC_DIVISION_2x3_LEFT, ABC_DIVISION_2x3_RIGHT, ABC_DIVISION_3x3
-from topo_entropy import calculate_s_subsystems
+from topo_entropy import calculate_s_subsystems, hamming_distance, pauli_subset_purities, purity_single_realization
+from topo_entropy import haar_tomography, haar_tomography_circuits, kitaev_preskill_sum, run_tomography
 from topo_entropy import get_all_2x2_non_corner, get_all_2x3_non_corner, get_all_3x3_non_corner
-from topo_entropy import get_all_2x3_left_non_corner, get_all_2x3_right_non_corner
+from topo_entropy import SHAPE_2x3_LEFT, get_all_2x3_left_non_corner, get_all_2x3_right_non_corner
+from topo_stabilizer import stabilizer_entropy, stabilizer_s_subsystems, topo_entropy_map
 from toric_code import get_toric_code
+from toric_code_matching import pauli_angles, sample_haar_angles
 
 
 def test_topo_entropy(backend, size, qubits, subsystems, expected_values, type='haar', cnt=1000, rtol=0.05):
     assert type in ('haar', 'pauli')
     print(qubits)
     x, y = size
-    all_counts = []
+    tc = get_toric_code(x, y, len(qubits))
     if type == 'haar':
-        all_gates = range(cnt)
+        tc.measure_haar(qubits, parameterized=True)
+        all_angles = sample_haar_angles((cnt, len(qubits)))
     elif type == 'pauli':
-        all_gates = [''.join(x) for x in itertools.product('xyz', repeat=len(qubits))]
-    for gates in tqdm(all_gates):
-        tc = get_toric_code(x, y, len(qubits))
-
-        if type == 'haar':
-            tc.measure_haar(qubits)
-        elif type == 'pauli':
-            tc.measure_pauli(qubits, gates)
-
-        job = backend.run(transpile(tc.circ, backend), shots=15000)  # note: number of shots is important
-        result = job.result()
-        counts = result.get_counts(tc.circ)
-        all_counts.append(counts)
-    calculated_values = calculate_s_subsystems(all_counts, subsystems)
+        tc.measure_pauli(qubits)
+        all_angles = (pauli_angles(''.join(gates)) for gates in itertools.product('xyz', repeat=len(qubits)))
+    circ = transpile(prune_to_light_cone(tc.circ), backend)
+    circuits = [tc.bind_measurement(circ, angles) for angles in tqdm(all_angles)]
+    all_counts = run_batched(backend, circuits, shots=15000)  # note: number of shots is important
+    estimator = 'pauli' if type == 'pauli' else 'randomized'
+    calculated_values = calculate_s_subsystems(all_counts, subsystems, estimator)
     print(expected_values, [c / np.log(2) for calc in calculated_values for c in calc])
     for expect, calc in zip(expected_values, calculated_values):
         for ve, vc in zip(expect, calc):
@@ -42,12 +50,127 @@ def test_topo_entropy(backend, size, qubits, subsystems, expected_values, type='
     return
 
 
+class TestEstimators(unittest.TestCase):
+    def test_purity_kernel(self):
+        rng = np.random.default_rng(0)
+        for q_cnt in (1, 3, 5):
+            outcomes = [format(v, f'0{q_cnt}b') for v in rng.integers(2 ** q_cnt, size=50)]
+            counts = {s: outcomes.count(s) for s in set(outcomes)}
+            N = sum(counts.values())
+            expected = sum(2 ** q_cnt * (-2.) ** (-hamming_distance(s1, s2)) * counts[s1] * (counts[s2] - 1)
+                           for s1 in counts for s2 in counts) / (N * (N - 1))
+            np.testing.assert_allclose(purity_single_realization(counts), expected)
+
+    def test_pauli_purity(self):
+        # Bell state, XX = ZZ = 1 and YY = -1, so equal bases give (anti)correlated bits and other settings uniform bits
+        N = 10000
+        all_counts = []
+        for g0, g1 in itertools.product('xyz', repeat=2):
+            if g0 != g1:
+                all_counts.append({s: N // 4 for s in ('00', '01', '10', '11')})
+            elif g0 == 'y':
+                all_counts.append({'01': N // 2, '10': N // 2})
+            else:
+                all_counts.append({'00': N // 2, '11': N // 2})
+        purities = pauli_subset_purities(all_counts, [(0,), (1,)])
+        np.testing.assert_allclose([purities[(0,)], purities[(1,)], purities[(0, 1)]], [0.5, 0.5, 1.], atol=1e-3)
+
+    def test_counts_table_marginal(self):
+        rng = np.random.default_rng(0)
+        all_counts = [{format(v, '06b'): int(c) for v, c in zip(*np.unique(rng.integers(64, size=100),
+                                                                            return_counts=True))}
+                      for _ in range(5)]
+        sub_idx = (4, 1, 3)
+        expected = []
+        for counts in all_counts:
+            sub_counts = {}
+            for s, c in counts.items():
+                s_sub = ''.join(s[i] for i in sub_idx)
+                sub_counts[s_sub] = sub_counts.get(s_sub, 0) + c
+            expected.append(dict(sorted(sub_counts.items())))
+        self.assertEqual(expected, CountsTable.from_counts(all_counts).marginal(sub_idx).to_counts())
+
+    def test_bootstrap_intervals(self):
+        rng = np.random.default_rng(0)
+        # realizations with 1 to 4 uniformly random bits
+        all_counts = [{format(v, '04b'): int(c)
+                       for v, c in zip(*np.unique(rng.integers(2 ** rng.integers(1, 5), size=200), return_counts=True))}
+                      for _ in range(200)]
+        subsets, topo = entropy_intervals(all_counts, ABC_DIVISION_2x2, resamples=2000, rng=1)
+        for estimate, low, high in list(subsets.values()) + [topo]:
+            self.assertLess(low, estimate)
+            self.assertLess(estimate, high)
+        replicas = bootstrap_subset_entropies(all_counts, ABC_DIVISION_2x2, resamples=2000, shots=False, rng=1)
+        topo_jk, err_jk = jackknife_topo_entropy(all_counts, ABC_DIVISION_2x2)
+        np.testing.assert_allclose(topo_jk, topo[0])
+        np.testing.assert_allclose(np.std(kitaev_preskill_sum(replicas)), err_jk, rtol=0.2)
+
+
 class TestMatchingEntropy(unittest.TestCase):
     def test_subsystem_count(self):
         self.assertEqual(14, len(get_all_2x2_non_corner((5, 7))))
         self.assertEqual(20, len(get_all_2x3_non_corner((5, 7))))
         self.assertEqual(3, len(get_all_3x3_non_corner((5, 7))))
 
+    def test_lattice_index(self):
+        x, y = 8, 11
+        lattice = get_lattice_index(x, y)
+        self.assertIs(lattice, get_lattice_index(x, y))
+        self.assertEqual(len(lattice), get_toric_code(x, y).ground_state.num_qubits)
+        np.testing.assert_array_equal(lattice.flat_index(lattice.coords), np.arange(len(lattice)))
+        self.assertEqual(-1, lattice.flat_index((0, x - 1)))
+
+        # the vectorized enumerator matches a scan of every anchor, in the same order
+        placements = []
+        for r in range(y):
+            for c in range(x):
+                sys = np.array(SHAPE_2x3_LEFT[r % 2]) + (r, c)
+                if lattice.contains(sys).all() and not lattice.is_corner(sys).any():
+                    placements.append(sys)
+        np.testing.assert_array_equal(lattice.placements(SHAPE_2x3_LEFT), placements)
+
+    def test_placement_groups(self):
+        placements = get_all_2x2_non_corner((5, 7))
+        groups = group_placements(placements)
+        self.assertEqual(list(range(len(placements))), sorted(i for group in groups for i in group))
+        for group in groups:
+            qubits = [q for i in group for q in placements[i]]
+            self.assertEqual(len(qubits), len(set(qubits)))
+        self.assertLess(len(groups), len(placements))
+
+    def test_lattice_dataset(self):
+        # synthetic dataset, the setting of qubit j in realization r is (r, row, col) of the qubit
+        rng = np.random.default_rng(0)
+        size = (5, 7)
+        qubits = lattice_qubits(size)
+        realizations = [[''.join(rng.choice(['0', '1'], len(qubits))) for _ in range(20)] for _ in range(3)]
+        all_counts = [{s: outcomes.count(s) for s in set(outcomes)} for outcomes in realizations]
+        settings = np.array([[(r, *q) for q in qubits] for r in range(len(realizations))])
+        dataset = CountsTable.from_counts(all_counts, settings)
+
+        placements = get_all_2x2_non_corner(size)
+        for placement in placements:
+            table = dataset_counts(dataset, size, placement)
+            # character i of the full bitstring is qubits[-1 - i], of the placement bitstring placement[-1 - i]
+            position = {q: len(qubits) - 1 - j for j, q in enumerate(qubits)}
+            for r, outcomes in enumerate(realizations):
+                marginal = [''.join(s[position[q]] for q in placement[::-1]) for s in outcomes]
+                self.assertEqual(table[[r]].to_counts()[0], {m: marginal.count(m) for m in set(marginal)})
+                np.testing.assert_array_equal(table.settings[r], [(r, *q) for q in placement])
+        self.assertEqual(list(dataset_topo_entropy_map(dataset, size, placements, ABC_DIVISION_2x2)),
+                         [tuple(p) for p in placements])
+
+    def test_grouped_pauli_tomography(self):
+        # the counts of every placement, split out of the shared circuits, give the exact entropies
+        size = (5, 5)
+        placements = get_all_2x2_non_corner(size)
+        tables = grouped_pauli_tomography(Aer.get_backend('aer_simulator'), size, placements, shots=4000)
+        for qubits, table in zip(placements, tables):
+            calculated = calculate_s_subsystems(table, ABC_DIVISION_2x2, 'pauli')
+            expected = stabilizer_s_subsystems(size, qubits, ABC_DIVISION_2x2)
+            for calc, expect in zip(calculated, expected):
+                np.testing.assert_allclose(calc, expect, atol=0.02)
+
     def test_2x2_entropy_pauli(self):
         expected_values = [(2., 1., 1.), (3., 3., 2.), (3.,)]
 
@@ -65,6 +188,51 @@ class TestMatchingEntropy(unittest.TestCase):
             test_topo_entropy(backend_sim, (x, y), qubits, ABC_DIVISION_2x2, expected_values, type='haar', cnt=100,
                               rtol=0.05)
 
+    def test_2x2_entropy_haar_adaptive(self):
+        backend_sim = Aer.get_backend('aer_simulator')
+        x, y = 5, 7
+        qubits = get_all_2x2_non_corner((x, y))[0]
+        topo, err, stream = calculate_topo_entropy_haar_adaptive(backend_sim, (x, y), qubits, ABC_DIVISION_2x2,
+                                                                 target_error=0.05, rng=0)
+        self.assertLessEqual(err, 0.05)
+        np.testing.assert_allclose(topo, -np.log(2), atol=4 * err)
+
+    def test_suggested_shots_without_spread(self):
+        # identical deterministic realizations have no variance at all
+        stream = StreamingTopoEntropy([[0], [1], [2]])
+        stream.update([{'000': 100}, {'000': 100}], rng=0)
+        self.assertAlmostEqual(0., stream.topo_entropy())
+        self.assertEqual(4096, stream.suggested_shots(max_shots=4096))
+
+    def test_parallel_sweep(self):
+        x, y = 5, 7
+        placements = get_all_2x2_non_corner((x, y))[:3]
+        topo_map = parallel_topo_entropy_map((x, y), placements, ABC_DIVISION_2x2, kind='pauli', shots=15000,
+                                             processes=2, seed=0)
+        self.assertEqual([tuple(p) for p in placements], list(topo_map))
+        np.testing.assert_allclose(list(topo_map.values()), -np.log(2), atol=0.02)
+        self.assertEqual({}, parallel_topo_entropy_map((x, y), [], ABC_DIVISION_2x2))
+
+    def test_result_store_resume(self):
+        backend_sim = Aer.get_backend('aer_simulator')
+        x, y = 5, 7
+        qubits = get_all_2x2_non_corner((x, y))[0]
+        angles = sample_haar_angles((20, len(qubits)), 0)
+        with tempfile.TemporaryDirectory() as root:
+            store = ResultStore(root)
+            # an interrupted sweep that ran only half of the settings
+            first = run_tomography(backend_sim, (x, y), qubits, angles[:10], haar_tomography_circuits, store=store)
+            # a store opened later indexes the same runs, and only the missing settings are run
+            store = ResultStore(root)
+            second = haar_tomography(backend_sim, (x, y), qubits, cnt=20, rng=0, store=store)
+            self.assertEqual(20, len(store))
+            self.assertEqual(2, len(store.runs()))
+            self.assertEqual(first.to_counts(), second[:10].to_counts())
+            np.testing.assert_allclose(second.settings, angles)
+            third = haar_tomography(backend_sim, (x, y), qubits, cnt=20, rng=0, store=store)
+            self.assertEqual(2, len(store.runs()))
+            self.assertEqual(second.to_counts(), third.to_counts())
+
     def test_2x3_entropy_pauli(self):
         expected_values = [(2., 2., 2.), (4., 3., 4.), (4.,)]
 
@@ -78,7 +246,7 @@ class TestMatchingEntropy(unittest.TestCase):
                               rtol=0.03)
 
     def test_2x3_entropy_haar(self):
-        expected_values = [(2., 2., 2.), (4., 4., 3.), (4.,)]
+        expected_values = [(2., 2., 2.), (4., 3., 4.), (4.,)]
 
         backend_sim = Aer.get_backend('aer_simulator')
         x, y = 5, 7
@@ -97,5 +265,31 @@ class TestMatchingEntropy(unittest.TestCase):
             test_topo_entropy(backend_sim, (x, y), qubits, ABC_DIVISION_3x3, expected_values, type='haar', cnt=1000)
 
 
+class TestStabilizerEntropy(unittest.TestCase):
+    def test_subsystem_entropies(self):
+        x, y = 5, 7
+        cases = [(get_all_2x2_non_corner, ABC_DIVISION_2x2, [(2., 1., 1.), (3., 3., 2.), (3.,)]),
+                 (get_all_2x3_left_non_corner, ABC_DIVISION_2x3_LEFT, [(2., 2., 2.), (4., 3., 4.), (4.,)]),
+                 (get_all_2x3_right_non_corner, ABC_DIVISION_2x3_RIGHT, [(2., 2., 2.), (4., 3., 4.), (4.,)]),
+                 (get_all_3x3_non_corner, ABC_DIVISION_3x3, [(3., 3., 3.), (6., 5., 4.), (5.,)])]
+        for get_all, subsystems, expected_values in cases:
+            for qubits in get_all((x, y)):
+                calculated_values = stabilizer_s_subsystems((x, y), qubits, subsystems)
+                for expect, calc in zip(expected_values, calculated_values):
+                    np.testing.assert_allclose(np.array(calc) / np.log(2), expect)
+
+    def test_large_lattice(self):
+        size = (15, 21)
+        for get_all, subsystems in [(get_all_2x2_non_corner, ABC_DIVISION_2x2),
+                                    (get_all_3x3_non_corner, ABC_DIVISION_3x3)]:
+            topo = topo_entropy_map(size, get_all(size), subsystems)
+            np.testing.assert_allclose(np.array(list(topo.values())) / np.log(2), -1.)
+
+    def test_off_lattice(self):
+        # (0, 4) is past the end of an even row of the 5x7 lattice
+        with self.assertRaises(AssertionError):
+            stabilizer_entropy((5, 7), [(0, 3), (0, 4)])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from qiskit import Aer, QuantumCircuit
+
+from executor import run_pipelined
+
+
+def bit_circuit(bit):
+    circ = QuantumCircuit(1, 1)
+    if bit:
+        circ.x(0)
+    circ.measure(0, 0)
+    return circ
+
+
+class TestPipelined(unittest.TestCase):
+    def test_task_order(self):
+        backend = Aer.get_backend('aer_simulator')
+        bits = [format(i, '03b') for i in range(8)]
+        for max_in_flight in (1, 2):
+            tasks = [(lambda b=b: [bit_circuit(int(c)) for c in b], lambda all_counts: ''.join(
+                max(counts, key=counts.get) for counts in all_counts)) for b in bits]
+            self.assertEqual(bits, list(run_pipelined(backend, tasks, shots=16, max_in_flight=max_in_flight)))
+
+    def test_prepare_error(self):
+        def failing():
+            raise ValueError('prepare failed')
+
+        backend = Aer.get_backend('aer_simulator')
+        tasks = [(lambda: [bit_circuit(1)], len), (failing, len)]
+        results = run_pipelined(backend, tasks, shots=16)
+        with self.assertRaises(ValueError):
+            list(results)
+
+
+if __name__ == '__main__':
+    unittest.main()
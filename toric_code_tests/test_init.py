@@ -2,9 +2,15 @@ import unittest
 
 import numpy as np
 from qiskit import Aer
-from qiskit import transpile
-
-from toric_code import get_toric_code
+from qiskit import QuantumCircuit, transpile
+from qiskit.circuit.classical import expr
+from qiskit.quantum_info import Pauli, StabilizerState
+
+from anyon_paths import string_operator
+from counts_table import register_counts
+from light_cone import prune_to_light_cone
+from stabilizer_readout import measure_stabilizers, stabilizer_matrix
+from toric_code import get_toric_code, ground_state_report
 from toric_code_matching import get_star_matching
 
 
@@ -25,9 +31,9 @@ def get_plaquette_ev(backend, size, plaquette_index):
     tc = get_toric_code(x, y)
 
     tc.measure_plaquette(py, px)
-    job = backend.run(transpile(tc.circ, backend), shots=1024)
+    job = backend.run(transpile(prune_to_light_cone(tc.circ), backend), shots=1024)
     result = job.result()
-    counts = result.get_counts(tc.circ)
+    counts = register_counts(result.get_counts(tc.circ))
     return count_to_parity(counts)
 
 
@@ -37,12 +43,40 @@ def get_star_ev(backend, size, star_index):
     tc = get_toric_code(x, y)
 
     tc.measure_star(sx, sy)
-    job = backend.run(transpile(tc.circ, backend), shots=1024)
+    job = backend.run(transpile(prune_to_light_cone(tc.circ), backend), shots=1024)
     result = job.result()
-    counts = result.get_counts(tc.circ)
+    counts = register_counts(result.get_counts(tc.circ))
     return count_to_parity(counts)
 
 
+def evaluate_condition(condition, bits):
+    # value of a classical expression of single bits, see init_measured
+    if isinstance(condition, expr.Var):
+        return bits[condition.var]
+    assert condition.op == expr.Binary.Op.BIT_XOR
+    return evaluate_condition(condition.left, bits) ^ evaluate_condition(condition.right, bits)
+
+
+def sample_stabilizer_state(circ, seed):
+    # one shot of a Clifford circuit with mid-circuit measurements and feed-forward, simulated exactly
+    state = StabilizerState(QuantumCircuit(circ.num_qubits))
+    state.seed(seed)
+    bits = {}
+    for inst in circ.data:
+        qargs = [circ.find_bit(q).index for q in inst.qubits]
+        if inst.operation.name == 'measure':
+            outcome, state = state.measure(qargs)
+            bits[inst.clbits[0]] = outcome == '1'
+        elif inst.operation.name == 'if_else':
+            if evaluate_condition(inst.operation.condition, bits):
+                body = inst.operation.blocks[0]
+                for body_inst in body.data:
+                    state = state.evolve(body_inst.operation, [qargs[body.find_bit(q).index] for q in body_inst.qubits])
+        elif inst.operation.name != 'barrier':
+            state = state.evolve(inst.operation, qargs)
+    return state
+
+
 class TestMatchingInit(unittest.TestCase):
     def test_plaquettes(self):
         x, y = 5, 7
@@ -72,6 +106,62 @@ class TestMatchingInit(unittest.TestCase):
                 ev = get_star_ev(backend_sim, (x, y), (i, j))
                 np.testing.assert_allclose(ev, 1)
 
+    def test_measured_preparation(self):
+        # every plaquette and star stabilizes the state whatever the syndrome, Aer's stabilizer method is not reliable
+        # and the syndrome ancillas are too many for a statevector
+        tc = get_toric_code(5, 7, preparation='measured')
+        lattice_qubits = sum(len(reg) for reg in tc.regs)
+        padding = 'I' * (tc.ground_state.num_qubits - lattice_qubits)
+        for seed in range(4):
+            state = sample_stabilizer_state(tc.ground_state, seed)
+            for kind, pauli in (('plaquette', 'X'), ('star', 'Z')):
+                for support in stabilizer_matrix(tc, kind).reshape(-1, lattice_qubits):
+                    label = padding + ''.join(pauli if s else 'I' for s in support[::-1])
+                    self.assertEqual(state.expectation_value(Pauli(label)), 1)
+
+    def test_schedules(self):
+        # every schedule prepares the same stabilizer state, with the same CNOTs count and no larger depth
+        for x, y in [(3, 3), (5, 7), (9, 13)]:
+            report = ground_state_report([(x, y)])
+            states = [StabilizerState(get_toric_code(x, y, schedule=schedule).ground_state)
+                      for _, schedule, _, _ in report]
+            for state in states[1:]:
+                self.assertTrue(states[0].equiv(state))
+            self.assertEqual(1, len({cx for _, _, _, cx in report}))
+            sequential_depth = report[0][2]
+            for _, _, depth, _ in report[1:]:
+                self.assertLessEqual(depth, sequential_depth)
+
+    def test_stabilizer_matrix(self):
+        # every plaquette and star, boundary stars included, stabilizes the ground state
+        tc = get_toric_code(5, 7)
+        state = StabilizerState(tc.ground_state)
+        for kind, pauli in (('plaquette', 'X'), ('star', 'Z')):
+            for support in stabilizer_matrix(tc, kind).reshape(-1, tc.ground_state.num_qubits):
+                label = ''.join(pauli if s else 'I' for s in support[::-1])
+                self.assertEqual(state.expectation_value(Pauli(label)), 1)
+
+    def test_stabilizer_readout(self):
+        # a statevector fits the measured preparation of a 5x3 lattice, Aer's stabilizer method is not reliable
+        x, y = 5, 3
+        backend_sim = Aer.get_backend('aer_simulator_statevector')
+        for preparation in ('unitary', 'measured'):
+            plaquettes, stars = measure_stabilizers(backend_sim, (x, y), shots=64, preparation=preparation)
+            np.testing.assert_allclose(plaquettes, 1)
+            np.testing.assert_allclose(stars, 1)
+
+        # an e string violates the stars at its ends, an m string the plaquettes at its ends,
+        # the syndrome register of a measured preparation precedes the readout register
+        paulis = string_operator([[(2, 1), (2, 2)]], [[(1, 4), (0, 3), (1, 3)]])
+        for preparation in ('unitary', 'measured'):
+            plaquettes, stars = measure_stabilizers(backend_sim, (x, y), shots=16, paulis=paulis,
+                                                    preparation=preparation, memory=True)
+            self.assertEqual(plaquettes.shape, (16, 1, 4))
+            self.assertEqual(stars.shape, (16, 2, 5))
+            self.assertEqual(np.argwhere(plaquettes.any(axis=0)).tolist(), [[0, 2], [0, 3]])
+            self.assertTrue(plaquettes[:, 0, [2, 3]].all())
+            self.assertEqual(np.argwhere(stars.any(axis=0)).tolist(), [[1, 1], [1, 3]])
+            self.assertTrue(stars[:, 1, [1, 3]].all())
 
 if __name__ == '__main__':
     unittest.main()
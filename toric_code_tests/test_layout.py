@@ -0,0 +1,26 @@
+import unittest
+
+from qiskit.providers.fake_provider import FakeWashington
+
+from layout import layout_report, lattice_layout
+from toric_code import get_toric_code
+
+
+class TestLayout(unittest.TestCase):
+    def test_heavy_hex_layout(self):
+        backend = FakeWashington()
+        for size, default_cx, cached_cx, default_depth, cached_depth in layout_report(backend, [(3, 3), (5, 7)]):
+            print(size, 'two-qubit gates', default_cx, '->', cached_cx, 'depth', default_depth, '->', cached_depth)
+            self.assertLessEqual(cached_cx, default_cx)
+
+    def test_layout_cache(self):
+        backend = FakeWashington()
+        tc = get_toric_code(5, 7)
+        layout = lattice_layout(backend, tc)
+        self.assertEqual(len(set(layout.values())), tc.ground_state.num_qubits)
+        # other instances of the same lattice reuse the layout
+        self.assertEqual(layout, lattice_layout(backend, get_toric_code(5, 7)))
+
+
+if __name__ == '__main__':
+    unittest.main()